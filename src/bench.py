@@ -0,0 +1,209 @@
+"""Benchmark of the RegEx Machine engines against the stdlib re module.
+
+Patterns of every family are matched in a generated corpus (the same for a given seed and size) by:
+* regex - RegEx facade, i.e. the engine the pattern is compiled to
+* interpreter - Interpreter
+* dfa - LazyDFA, for patterns it supports
+* bit-parallel - BitParallel, for patterns with few enough positions
+* codegen - RegEx with codegen, i.e. CompiledDFA for patterns it can compile
+* re - stdlib re, finditer
+Throughput (MB/s of utf-8 text), time per match, peak memory of a run (tracemalloc) and number of matches are
+reported, results can be saved as JSON and compared with the results of an earlier run.
+
+Usage: python bench.py [--size KB] [--repeat N] [--family NAME] [--engine NAME] [--output FILE] [--compare FILE]
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import random
+import re
+import time
+import tracemalloc
+
+from regex import RegEx
+from interpreter import Interpreter
+from dfa import LazyDFA
+from codegen import CompiledDFA
+from bit_parallel import BitParallel
+
+# family -> (kind of text, patterns)
+families = {
+    "literals": ("mixed", ["Mehl", "coin dealer", "1884"]),
+    "classes": ("mixed", ["[A-Z][a-z]+", "\\d+", "[^ \\n]+", "0[xX][A-Fa-f0-9]+"]),
+    "alternations": ("mixed", ["coin|dealer|auction", "(\\d{2}|\\d{4}):(\\d{2})", "(Mehl|Max)\\s(\\w+)"]),
+    "bounded repeats": ("mixed", ["\\d{2,4}", "[a-z]{3,5}ing", "(ab){2,3}"]),
+    "back references": ("mixed", ["(\\w)\\1", "(\\d+):\\1", "([a-z]+) \\1"]),
+    "unicode properties": ("mixed", ["\\p{Greek}+", "\\p{L}+", "\\p{Lu}\\p{Ll}+", "\\p{Cyrillic}+"]),
+    "pathological": ("pathological", ["(a*)*b", "(a|aa)*c", "(a+a+)+b"]),
+}
+
+engines = ["regex", "interpreter", "dfa", "bit-parallel", "codegen", "re"]
+
+words = ["coin", "dealer", "Mehl", "Max", "auction", "collector", "Fort", "Worth", "Texas", "nickel", "hobby",
+         "selling", "abab", "ababab", "ring", "sing"]
+greek_words = ["Καλημέρα", "κόσμε", "νόμισμα", "Ελλάδα"]
+cyrillic_words = ["Привет", "мир", "монета"]
+
+
+def generate_text(kind, size, seed):
+    """Returns text of about size characters, the same for the same arguments"""
+    rnd = random.Random(seed)
+    if kind == "pathological":
+        # runs of a's the backtracking of re explores exponentially, limited to keep re runs short
+        return ("a" * rnd.randint(10, 14) + rnd.choice("bcc")) * max(1, size // 4096)
+
+    parts = []
+    length = 0
+    while length < size:
+        choice = rnd.random()
+        if choice < 0.6:
+            part = rnd.choice(words)
+        elif choice < 0.7:
+            part = str(rnd.randint(0, 99999))
+        elif choice < 0.75:
+            part = "%d:%02d" % (rnd.randint(10, 2021), rnd.randint(1, 12))
+        elif choice < 0.8:
+            part = "0x%X" % rnd.randint(0, 0xFFFFFF)
+        elif choice < 0.85:
+            part = rnd.choice(greek_words)
+        elif choice < 0.9:
+            part = rnd.choice(cyrillic_words)
+        elif choice < 0.95:
+            part = rnd.choice(words) + " " + rnd.choice(words)
+        else:
+            part = "\n"
+        parts.append(part)
+        length += len(part) + 1
+    return " ".join(parts)
+
+
+def make_runner(engine, pattern):
+    """Returns function text -> number of matches, None if the engine can't match the pattern"""
+    if engine == "re":
+        try:
+            compiled = re.compile(pattern)
+        except re.error:  # e.g. \p{...} isn't supported by re
+            return None
+        return lambda text: sum(1 for _ in compiled.finditer(text))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        regex = RegEx(pattern)
+    if regex.engine is None:
+        return None
+    if engine == "regex":
+        matcher = regex.engine
+    elif engine == "bit-parallel":
+        matcher = BitParallel.compile(regex.engine.nfa)
+        if matcher is None:
+            return None
+    elif engine == "codegen":
+        matcher = RegEx(pattern, codegen=True).engine
+        if not isinstance(matcher, CompiledDFA):
+            return None
+    elif engine == "interpreter":
+        matcher = Interpreter(regex.engine.nfa)
+    elif LazyDFA.supports(regex.engine.nfa):
+        matcher = LazyDFA(regex.engine.nfa)
+    else:
+        return None
+    return lambda text: len(matcher.match_all(text))
+
+
+def run(runner, text, repeat):
+    """Returns (best time of the runs, number of matches, peak memory in bytes)"""
+    best = None
+    matches = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        matches = runner(text)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    runner(text)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, matches, peak
+
+
+def benchmark(size, repeat, seed, selected_families, selected_engines):
+    """Returns list of result dicts, one for every family, pattern and engine"""
+    texts = {}
+    results = []
+    for family in selected_families:
+        kind, patterns = families[family]
+        if kind not in texts:
+            texts[kind] = generate_text(kind, size, seed)
+        text = texts[kind]
+        megabytes = len(text.encode("utf-8")) / 1e6
+        for pattern in patterns:
+            for engine in selected_engines:
+                runner = make_runner(engine, pattern)
+                if runner is None:
+                    continue
+                elapsed, matches, peak = run(runner, text, repeat)
+                results.append({
+                    "family": family,
+                    "pattern": pattern,
+                    "engine": engine,
+                    "text_bytes": len(text.encode("utf-8")),
+                    "seconds": elapsed,
+                    "mb_per_s": megabytes / elapsed if elapsed > 0 else None,
+                    "us_per_match": elapsed * 1e6 / matches if matches > 0 else None,
+                    "matches": matches,
+                    "peak_memory": peak,
+                })
+    return results
+
+
+def result_key(result):
+    return result["family"], result["pattern"], result["engine"]
+
+
+def print_results(results, baseline=None):
+    """Prints table of the results, with speedup against the baseline results if given"""
+    baseline = {result_key(result): result for result in baseline or []}
+    header = "%-18s %-24s %-12s %10s %12s %10s %12s" % ("family", "pattern", "engine", "MB/s", "us/match",
+                                                         "matches", "peak KB")
+    if len(baseline) > 0:
+        header += " %9s" % "speedup"
+    print(header)
+    for result in results:
+        line = "%-18s %-24s %-12s %10.3f %12s %10d %12.1f" % (
+            result["family"], result["pattern"][:24], result["engine"], result["mb_per_s"] or 0,
+            "-" if result["us_per_match"] is None else "%.2f" % result["us_per_match"], result["matches"],
+            result["peak_memory"] / 1024)
+        before = baseline.get(result_key(result))
+        if before is not None and result["seconds"] > 0:
+            line += " %8.2fx" % (before["seconds"] / result["seconds"])
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the RegEx Machine engines and the re module")
+    parser.add_argument("--size", type=int, default=64, help="size of the generated text in KB")
+    parser.add_argument("--repeat", type=int, default=3, help="number of timed runs, the best is reported")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the text generator")
+    parser.add_argument("--family", action="append", choices=list(families), help="pattern family to run")
+    parser.add_argument("--engine", action="append", choices=engines, help="engine to run")
+    parser.add_argument("--output", help="JSON file to save the results to")
+    parser.add_argument("--compare", help="JSON file of earlier results to compare with")
+    args = parser.parse_args()
+
+    results = benchmark(args.size * 1024, args.repeat, args.seed, args.family or list(families),
+                        args.engine or engines)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)["results"]
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"size": args.size, "repeat": args.repeat, "seed": args.seed, "results": results}, file,
+                      indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+from bisect import bisect_right
+
+from dfa import LazyDFA
+from codegen import CompiledDFA
+from state_machine import State
+
+
+class BitParallel(LazyDFA):
+    """Bit-parallel (Glushkov style) matching engine for patterns with a small number of positions.
+
+    Position is a configuration of the NFA, as in the LazyDFA: (consuming NFA state, number of characters of the
+    state already matched, repetition counters). Every position has a bit, the set of active positions is a single int.
+    A character is matched with precomputed masks:
+    * char_mask(c) - positions matching the character c, looked up in a list for ascii characters
+    * shift_mask - positions followed only by the next position, they advance by a single shift
+    * follow tables - positions followed by other positions, their follow sets are ORed from tables indexed by
+      8 bits of the active positions
+    * accept_mask - positions followed by END, a match ends after them
+    so the next set of positions is ((active & mask & shift_mask) << 1) | follow(active & mask & ~shift_mask).
+
+    Patterns the LazyDFA doesn't support or with more than max_positions positions aren't compiled, see compile().
+    Matches are searched for and match groups found the same way as by the LazyDFA.
+    """
+
+    max_positions = 64
+    chunk_bits = 8
+    memo_size = 4096  # number of non ascii characters the masks are kept for
+
+    def __init__(self, nfa):
+        super().__init__(nfa)
+        self.positions = []  # configurations, index is the bit of the position
+        self.start_mask = 0
+        self.shift_mask = 0
+        self.accept_mask = 0
+        self.follow_tables = []  # (shift, table of follow sets of 2 ** chunk_bits values of the chunk)
+        self.pattern_nos = []  # (bit, set of pattern_no of END states reached after the position)
+        self.range_starts = []  # per position, first code points of the matched ranges
+        self.range_ends = []
+        self.ascii_masks = []
+        self.memo = {}  # code point >= 128 -> mask
+
+    @staticmethod
+    def compile(nfa):
+        """Returns BitParallel engine of the NFA, None if the pattern doesn't fit"""
+        if not LazyDFA.supports(nfa):
+            return None
+        engine = BitParallel(nfa)
+        if not engine.build():
+            return None
+        return engine
+
+    def build(self):
+        """Numbers the positions reachable from the START node and builds the masks, returns False if the pattern
+        can't be matched by the engine"""
+        start_state = self.get_start_state()
+        index = {}  # configuration -> bit
+        follows = []  # per position, (configurations followed, set of pattern_no reached)
+
+        def add_positions(configs):
+            for config in sorted(configs, key=lambda c: (c[0].state_no, c[1], c[2])):
+                if config not in index:
+                    index[config] = len(self.positions)
+                    self.positions.append(config)
+
+        add_positions(start_state.configs)
+        position = 0
+        while position < len(self.positions):
+            if len(self.positions) > BitParallel.max_positions:
+                return False
+            nfa_state, matched_len, counters = self.positions[position]
+            ranges = CompiledDFA.code_point_ranges(nfa_state, matched_len)
+            if ranges is None:
+                return False
+            self.range_starts.append([first for first, _ in ranges])
+            self.range_ends.append([last for _, last in ranges])
+
+            configs = set()
+            accepting = set()
+            if nfa_state.state_type in State.literal_types and matched_len + 1 < len(nfa_state.match_values[0]):
+                configs.add((nfa_state, matched_len + 1, counters))
+            else:
+                accepting = self.leave(nfa_state, counters, configs, set())
+            add_positions(configs)
+            follows.append((configs, accepting))
+            position += 1
+        if len(self.positions) > BitParallel.max_positions:
+            return False
+
+        self.start_mask = self.to_mask(start_state.configs, index)
+        jump_follows = {}  # bit -> follow set of positions not advanced by the shift
+        for bit, (configs, accepting) in enumerate(follows):
+            follow_mask = self.to_mask(configs, index)
+            if len(accepting) > 0:
+                self.accept_mask |= 1 << bit
+                self.pattern_nos.append((bit, accepting))
+            if follow_mask == 1 << (bit + 1):
+                self.shift_mask |= 1 << bit
+            elif follow_mask != 0:
+                jump_follows[bit] = follow_mask
+
+        chunk_size = 1 << BitParallel.chunk_bits
+        for shift in range(0, len(self.positions), BitParallel.chunk_bits):
+            bits = [bit for bit in jump_follows if shift <= bit < shift + BitParallel.chunk_bits]
+            if len(bits) == 0:
+                continue
+            table = [0] * chunk_size
+            for value in range(1, chunk_size):
+                low_bit = (value & -value).bit_length() - 1
+                table[value] = table[value & (value - 1)] | jump_follows.get(shift + low_bit, 0)
+            self.follow_tables.append((shift, table))
+
+        self.ascii_masks = [self.compute_mask(code_point) for code_point in range(128)]
+        return True
+
+    @staticmethod
+    def to_mask(configs, index):
+        """Returns mask of bits of the configurations"""
+        mask = 0
+        for config in configs:
+            mask |= 1 << index[config]
+        return mask
+
+    def compute_mask(self, code_point):
+        """Returns mask of the positions matching the code point"""
+        mask = 0
+        for bit in range(len(self.positions)):
+            range_index = bisect_right(self.range_starts[bit], code_point) - 1
+            if range_index >= 0 and code_point <= self.range_ends[bit][range_index]:
+                mask |= 1 << bit
+        return mask
+
+    def char_mask(self, code_point):
+        """Returns mask of the positions matching the code point, for non ascii characters"""
+        mask = self.memo.get(code_point)
+        if mask is None:
+            mask = self.compute_mask(code_point)
+            if len(self.memo) < BitParallel.memo_size:
+                self.memo[code_point] = mask
+        return mask
+
+    def match_end(self, text, position, dead_states):
+        """Runs the positions from the position, returns end of the longest match or None and pattern_no of patterns
+        matching there. Sets of positions visited after the last match end are recorded in dead_states, see
+        LazyDFA.match_end"""
+        active = self.start_mask
+        ascii_masks = self.ascii_masks
+        shift_mask = self.shift_mask
+        accept_mask = self.accept_mask
+        follow_tables = self.follow_tables
+        chunk_mask = (1 << BitParallel.chunk_bits) - 1
+        start_position = position
+        match_end = None
+        match_bits = 0
+        visited = []
+
+        while active and position < len(text):
+            if dead_states:
+                dead = dead_states.get(position)
+                if dead is not None and active in dead:
+                    break
+            visited.append(active)
+            code_point = ord(text[position])
+            matched = active & (ascii_masks[code_point] if code_point < 128 else self.char_mask(code_point))
+            position += 1
+            if matched & accept_mask:
+                match_end = position
+                match_bits = matched & accept_mask
+            active = (matched & shift_mask) << 1
+            jumps = matched & ~shift_mask
+            if jumps:
+                for shift, table in follow_tables:
+                    active |= table[(jumps >> shift) & chunk_mask]
+
+        self.record_dead_states(dead_states, visited, start_position, match_end)
+        if match_end is None:
+            return None, None
+        accepting = set()
+        for bit, pattern_nos in self.pattern_nos:
+            if match_bits & (1 << bit):
+                accepting.update(pattern_nos)
+        return match_end, frozenset(accepting)
@@ -0,0 +1,187 @@
+from bisect import bisect_right
+
+import unicode
+from dfa import LazyDFA
+from state_machine import State
+
+
+class CompiledDFA(LazyDFA):
+    """LazyDFA with all states built up front and match_end generated as Python source.
+
+    States are explored from the start state, the transitions of every state are computed once per range of code
+    points the NFA states of its configurations can tell apart. The generated match_end keeps the DFA state in an
+    integer, dispatches on it with a binary tree of comparisons and tests the character with inlined comparisons
+    (or a lookup table for states with many ranges), no DFA state objects or dict lookups are touched per
+    character. Accepting states are numbered last, so a match end is a single comparison.
+
+    Patterns the LazyDFA doesn't support or with more than max_states DFA states aren't compiled, see compile().
+    The source is compiled with compile()/exec, it's kept in self.source for inspection.
+    """
+
+    max_states = 512
+    max_inline_ranges = 4  # states with more ranges test the character with bisect of a table
+
+    def __init__(self, nfa):
+        super().__init__(nfa, cache_size=float("inf"))
+        self.source = None
+        self.namespace = {}
+        self.state_ranges = {}  # DFAState -> list of (first code point, last code point, next DFAState)
+        self.state_numbers = None  # DFAState -> number in the generated code
+        self.first_accepting = 0
+
+    @staticmethod
+    def compile(nfa, pattern=""):
+        """Returns CompiledDFA of the NFA, None if the DFA can't be built or has too many states"""
+        if not LazyDFA.supports(nfa):
+            return None
+        compiled = CompiledDFA(nfa)
+        if not compiled.build():
+            return None
+        compiled.generate(pattern)
+        return compiled
+
+    @staticmethod
+    def code_point_ranges(nfa_state, matched_len):
+        """Returns sorted list of (first, last) code points the NFA state matches after matched_len characters,
+        None if the state can't be compiled"""
+        if nfa_state.state_type in State.literal_types:
+            code_point = ord(nfa_state.match_values[0][matched_len])
+            return [(code_point, code_point)]
+        if nfa_state.state_type == "match all":
+            return [(0, unicode.max_code_point)]
+        if nfa_state.state_type == "multi match":
+            return unicode.negate_ranges(nfa_state.ranges) if nfa_state.is_negative else nfa_state.ranges
+        if nfa_state.state_type == "u-multi match":
+            return nfa_state.matched_ranges()
+        return None
+
+    def build(self):
+        """Builds all DFA states reachable from the start state, returns False if it isn't possible"""
+        self.start_state = self.get_start_state()
+        states = [self.start_state]
+        found = {self.start_state}
+        for state in states:
+            boundaries = {0, unicode.max_code_point + 1}
+            for nfa_state, matched_len, _ in state.configs:
+                ranges = self.code_point_ranges(nfa_state, matched_len)
+                if ranges is None:
+                    return False
+                for first, last in ranges:
+                    boundaries.update([first, last + 1])
+
+            boundaries = sorted(boundaries)
+            ranges = []
+            for first, next_first in zip(boundaries, boundaries[1:]):
+                next_state = self.add_transition(state, chr(first))
+                if next_state.is_dead() and not next_state.accepting:
+                    continue
+                if len(ranges) > 0 and ranges[-1][1] == first - 1 and ranges[-1][2] is next_state:
+                    ranges[-1] = (ranges[-1][0], next_first - 1, next_state)
+                else:
+                    ranges.append((first, next_first - 1, next_state))
+                if next_state not in found:
+                    found.add(next_state)
+                    states.append(next_state)
+                    if len(states) > CompiledDFA.max_states:
+                        return False
+            self.state_ranges[state] = ranges
+
+        # accepting states last
+        ordered = [state for state in states if not state.accepting] + [state for state in states if state.accepting]
+        self.state_numbers = {state: number for number, state in enumerate(ordered)}
+        self.first_accepting = len(states) - sum(1 for state in states if state.accepting)
+        return True
+
+    def generate(self, pattern):
+        """Generates source of match_end and compiles it"""
+        numbers = self.state_numbers
+        ordered = sorted(numbers, key=numbers.get)
+        lines = [
+            "def match_end(text, position, dead_states):",
+            "    state = %d" % numbers[self.start_state],
+            "    start_position = position",
+            "    length = len(text)",
+            "    match_end = None",
+            "    match_state = -1",
+            "    visited = []",
+            "    while position < length:",
+            "        if dead_states:",
+            "            dead = dead_states.get(position)",
+            "            if dead is not None and state in dead:",
+            "                break",
+            "        visited.append(state)",
+            "        c = ord(text[position])",
+        ]
+        self.namespace = {"bisect_right": bisect_right, "record_dead_states": LazyDFA.record_dead_states,
+                          "ACCEPTING": tuple(state.accepting for state in ordered)}
+        self.generate_dispatch(ordered, 0, len(ordered), 2, lines)
+        lines += [
+            "        position += 1",
+            "        if state >= %d:" % self.first_accepting,
+            "            match_end = position",
+            "            match_state = state",
+            "    record_dead_states(dead_states, visited, start_position, match_end)",
+            "    return match_end, None if match_end is None else ACCEPTING[match_state]",
+        ]
+        self.source = "\n".join(lines) + "\n"
+        if self.verbose > 0:
+            print(self.source)
+        exec(compile(self.source, "<regex %s>" % pattern, "exec"), self.namespace)
+        self.match_end = self.namespace["match_end"]
+
+    def generate_dispatch(self, ordered, first, last, indent, lines):
+        """Appends code of the states numbered first to last - 1, chosen by binary search on the state number"""
+        prefix = "    " * indent
+        if last - first == 1:
+            self.generate_state(ordered[first], indent, lines)
+            return
+        middle = (first + last) // 2
+        lines.append(prefix + "if state < %d:" % middle)
+        self.generate_dispatch(ordered, first, middle, indent + 1, lines)
+        lines.append(prefix + "else:")
+        self.generate_dispatch(ordered, middle, last, indent + 1, lines)
+
+    def generate_state(self, state, indent, lines):
+        """Appends code of the transitions of the state, it sets the next state or breaks out of the loop"""
+        prefix = "    " * indent
+        number = self.state_numbers[state]
+        ranges = self.state_ranges[state]
+        if len(ranges) == 0:
+            lines.append(prefix + "break")
+        elif len(ranges) <= CompiledDFA.max_inline_ranges:
+            keyword = "if"
+            for first, last, next_state in ranges:
+                if first == last:
+                    test = "c == %d" % first
+                else:
+                    test = "%d <= c <= %d" % (first, last)
+                lines.append(prefix + "%s %s:" % (keyword, test))
+                lines.append(prefix + "    state = %d" % self.state_numbers[next_state])
+                keyword = "elif"
+            lines.append(prefix + "else:")
+            lines.append(prefix + "    break")
+        else:
+            # table of range starts, gaps between the ranges lead to -1
+            starts = []
+            targets = []
+            next_first = 0
+            for first, last, next_state in ranges:
+                if first > next_first:
+                    starts.append(next_first)
+                    targets.append(-1)
+                starts.append(first)
+                targets.append(self.state_numbers[next_state])
+                next_first = last + 1
+            starts.append(next_first)
+            targets.append(-1)
+            self.namespace["S%d" % number] = tuple(starts)
+            self.namespace["T%d" % number] = tuple(targets)
+            # ascii characters are looked up directly
+            self.namespace["A%d" % number] = tuple(targets[bisect_right(starts, code_point) - 1]
+                                                   for code_point in range(128))
+            lines.append(prefix + "if c < 128:")
+            lines.append(prefix + "    state = A%d[c]" % number)
+            lines.append(prefix + "else:")
+            lines.append(prefix + "    state = T%d[bisect_right(S%d, c) - 1]" % (number, number))
+            lines.append(prefix + "if state < 0:")
+            lines.append(prefix + "    break")
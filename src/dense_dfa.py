@@ -0,0 +1,211 @@
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, without it RegEx.match_batch falls back to the engine
+    np = None
+
+import unicode
+from codegen import CompiledDFA
+from interpreter import MatchResult
+
+
+class DenseDFA(CompiledDFA):
+    """DFA with a dense transition table over character classes, for bulk matching with numpy.
+
+    Code points are split into classes, the ranges between boundaries of all the character tests of the pattern
+    (literals, MultiMatchState and MultiMatchUnicodeState ranges), code points of a class can't be told apart by
+    any DFA state. Text is mapped to an array of class ids by a single vectorized searchsorted, the DFA then steps
+    table[state, class]:
+    * finditer / match_all - the class ids of the text are computed once, stepping is a list lookup per character
+    * match_batch - many texts are matched in lockstep, one column (character position) of a 2-D array of class ids
+      at a time, every step is a single array lookup for all the texts not known to be dead. Class ids are computed
+      block_columns positions at a time, only for the texts still alive, at most max_batch_texts texts are stepped
+      together and texts longer than max_batch_length are stepped one by one (see match_length), so the memory used
+      is bounded
+    The last row of the table is the dead state, the last class is padding after the end of a text.
+    Needs numpy, compile() returns None without it.
+    """
+
+    block_columns = 256
+    max_batch_texts = 4096
+    max_batch_length = 4096
+
+    def __init__(self, nfa):
+        super().__init__(nfa)
+        self.class_starts = None  # numpy array of the first code points of the classes
+        self.table = None  # numpy array state x class -> state
+        self.rows = None  # table as lists, for stepping a single text
+        self.numbered_states = []  # DFA states by their numbers
+        self.dead = 0  # number of the dead state
+        self.is_accepting = None  # numpy array state -> True if a match ends after reaching it
+        self.class_dtype = None  # smallest numpy integer type of the class ids
+        self.classified_text = None  # text the class ids were computed for
+        self.class_ids = None
+
+    @staticmethod
+    def compile(nfa, pattern=""):
+        """Returns DenseDFA of the NFA, None if numpy isn't available or the DFA can't be built"""
+        if np is None or not CompiledDFA.supports(nfa):
+            return None
+        dense = DenseDFA(nfa)
+        if not dense.build():
+            return None
+        dense.build_table()
+        return dense
+
+    def build_table(self):
+        """Builds the character classes and the transition table from the ranges of the DFA states"""
+        boundaries = {0}
+        for ranges in self.state_ranges.values():
+            for first, last, _ in ranges:
+                boundaries.update([first, last + 1])
+        class_starts = sorted(boundary for boundary in boundaries if boundary <= unicode.max_code_point)
+        self.class_starts = np.array(class_starts, dtype=np.int64)
+
+        state_count = len(self.state_numbers)
+        self.dead = state_count
+        pad_class = len(class_starts)
+        self.table = np.full((state_count + 1, pad_class + 1), self.dead, dtype=np.int32)
+        self.class_dtype = next(dtype for dtype in [np.uint8, np.uint16, np.int32] if pad_class <= np.iinfo(dtype).max)
+        for state, ranges in self.state_ranges.items():
+            row = self.table[self.state_numbers[state]]
+            for first, last, next_state in ranges:
+                first_class = np.searchsorted(self.class_starts, first, side="right") - 1
+                last_class = np.searchsorted(self.class_starts, last, side="right") - 1
+                row[first_class:last_class + 1] = self.state_numbers[next_state]
+        self.rows = self.table.tolist()
+
+        self.is_accepting = np.zeros(state_count + 1, dtype=bool)
+        self.is_accepting[self.first_accepting:state_count] = True
+        self.numbered_states = sorted(self.state_numbers, key=self.state_numbers.get)
+
+    def classify(self, text):
+        """Returns numpy array of the class ids of the characters of the text"""
+        code_points = np.frombuffer(text.encode("utf-32-le", "surrogatepass"), dtype="<u4")
+        return (np.searchsorted(self.class_starts, code_points, side="right") - 1).astype(self.class_dtype)
+
+    def classify_block(self, texts):
+        """Returns 2-D numpy array of the class ids of the texts, a row per text, padded to the longest text"""
+        lengths = np.array([len(text) for text in texts], dtype=np.int64)
+        pad_class = self.table.shape[1] - 1
+        class_ids = np.full((len(texts), int(lengths.max())), pad_class, dtype=self.class_dtype)
+        rows = np.repeat(np.arange(len(texts)), lengths)
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        columns = np.arange(int(lengths.sum())) - np.repeat(offsets, lengths)
+        class_ids[rows, columns] = self.classify("".join(texts))
+        return class_ids
+
+    def get_class_ids(self, text):
+        """Returns list of the class ids of the text, computed once for the text matched"""
+        if self.classified_text is not text:
+            self.class_ids = self.classify(text).tolist()
+            self.classified_text = text
+        return self.class_ids
+
+    def match_end(self, text, position, dead_states):
+        """Steps the table from the position, returns end of the longest match or None and pattern_no of patterns
+        matching there. States visited after the last match end are recorded in dead_states, see LazyDFA.match_end"""
+        class_ids = self.get_class_ids(text)
+        rows = self.rows
+        dead = self.dead
+        first_accepting = self.first_accepting
+        state = self.state_numbers[self.start_state]
+        start_position = position
+        match_end = None
+        match_state = -1
+        visited = []
+
+        while position < len(text):
+            if dead_states:
+                dead_set = dead_states.get(position)
+                if dead_set is not None and state in dead_set:
+                    break
+            visited.append(state)
+            state = rows[state][class_ids[position]]
+            if state == dead:
+                break
+            position += 1
+            if state >= first_accepting:
+                match_end = position
+                match_state = state
+
+        self.record_dead_states(dead_states, visited, start_position, match_end)
+        if match_end is None:
+            return None, None
+        return match_end, self.numbered_states[match_state].accepting
+
+    def match_lengths(self, texts):
+        """Returns (numpy array of the lengths of the longest matches at the start of the texts, -1 if a text
+        doesn't match there, numpy array of the states the matches ended in). The texts are stepped in lockstep,
+        block_columns positions of the texts still alive are classified at a time"""
+        ends = np.full(len(texts), -1, dtype=np.int64)
+        end_states = np.full(len(texts), self.dead, dtype=np.int32)
+        alive = np.arange(len(texts))  # texts still alive
+        states = np.full(len(texts), self.state_numbers[self.start_state], dtype=np.int32)
+        block_start = 0
+        while len(alive) > 0:
+            block_end = block_start + DenseDFA.block_columns
+            block = [texts[text_index][block_start:block_end] for text_index in alive.tolist()]
+            if max(len(text) for text in block) == 0:
+                break
+            class_ids = self.classify_block(block)
+            rows = np.arange(len(alive))  # rows of class_ids of the texts still alive
+            for column in range(class_ids.shape[1]):
+                states = self.table[states, class_ids[rows, column]]
+                accepted = self.is_accepting[states]
+                ends[alive[accepted]] = block_start + column + 1
+                end_states[alive[accepted]] = states[accepted]
+                live = states != self.dead
+                if not live.all():
+                    alive = alive[live]
+                    rows = rows[live]
+                    states = states[live]
+                    if len(alive) == 0:
+                        break
+            block_start += DenseDFA.block_columns
+        return ends, end_states
+
+    def match_length(self, text):
+        """Returns (length of the longest match at the start of the text, -1 if the text doesn't match there, state
+        the match ended in). Steps the table over a single text, max_batch_length positions are classified at a time"""
+        rows = self.rows
+        dead = self.dead
+        first_accepting = self.first_accepting
+        state = self.state_numbers[self.start_state]
+        end = -1
+        end_state = dead
+        for block_start in range(0, len(text), DenseDFA.max_batch_length):
+            block = text[block_start:block_start + DenseDFA.max_batch_length]
+            for position, class_id in enumerate(self.classify(block).tolist(), block_start + 1):
+                state = rows[state][class_id]
+                if state == dead:
+                    return end, end_state
+                if state >= first_accepting:
+                    end = position
+                    end_state = state
+        return end, end_state
+
+    def match_result(self, text, end, end_state):
+        """Returns MatchResult of the match at the start of the text found by match_lengths or match_length"""
+        if end < 0:
+            return None
+        match_result = MatchResult(text, 0, end, engine=self)
+        match_result.pattern_no = min(self.numbered_states[end_state].accepting)
+        return match_result
+
+    def match_batch(self, texts):
+        """Returns list of the longest matches at the start of the texts, None for texts which don't match there"""
+        texts = list(texts)
+        ret = [None] * len(texts)
+        batch = []  # indexes of the texts matched in lockstep
+        for text_index, text in enumerate(texts):
+            if len(text) > DenseDFA.max_batch_length:
+                ret[text_index] = self.match_result(text, *self.match_length(text))
+            else:
+                batch.append(text_index)
+
+        for first in range(0, len(batch), DenseDFA.max_batch_texts):
+            text_indexes = batch[first:first + DenseDFA.max_batch_texts]
+            ends, end_states = self.match_lengths([texts[text_index] for text_index in text_indexes])
+            for text_index, end, end_state in zip(text_indexes, ends.tolist(), end_states.tolist()):
+                ret[text_index] = self.match_result(texts[text_index], end, end_state)
+        return ret
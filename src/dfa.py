@@ -0,0 +1,267 @@
+from interpreter import Interpreter, MatchResult
+from state_machine import NFA, State
+from prefilter import Prefilter
+
+
+class DFAState:
+    """State of the lazily built DFA: a set of NFA configurations waiting for the next character.
+    Configuration is a tuple (NFA state, number of characters of the state already matched, repetition counters).
+    """
+
+    def __init__(self, configs, accepting):
+        self.configs = configs  # frozenset of configurations
+        self.accepting = accepting  # frozenset of pattern_no of END states reached, i.e. a match ends here if not empty
+        self.transitions = {}  # character -> DFAState
+
+    def is_dead(self):
+        return len(self.configs) == 0
+
+
+class LazyDFA:
+    """Matching engine building DFA states on demand from sets of NFA states.
+
+    DFA state is created (and cached) the first time the matching reaches it, every transition is cached as well,
+    so characters seen before cost a single dict lookup. The cache is flushed once it holds more than cache_size
+    entries (states and transitions), this way patterns with a large number of DFA states use bounded memory.
+
+    Patterns with back references or anchors depend on more than the current set of states, they're not supported
+    (see supports()) and have to be matched with the Interpreter.
+    DFA doesn't track match groups, they're found by the Interpreter when a match result is asked for them.
+
+    In search mode, used by RegexSet, the DFA looks for matches starting anywhere in text: START configurations are
+    added to every DFA state, so a single pass over text finds all patterns of a pattern set matching it.
+    """
+
+    epsilon_types = ["repetition", "expression"]
+
+    def __init__(self, nfa, cache_size=10000, search=False):
+        self.nfa = nfa
+        self.search = search
+        self.cache_size = cache_size
+        self.verbose = 0
+        self.rec_count = max([state.rec_no + 1 for state in NFA.reachable_states(nfa)
+                              if state.state_type == "repetition"], default=0)
+        self.states = {}  # (frozenset of configurations, accepting) -> DFAState
+        self.cache_entries = 0
+        self.start_state = None
+        self.start_configs = None  # configurations of the START node, added to every DFA state in search mode
+        self.interpreter = None  # finds match groups, created on demand
+        prefilter = Prefilter(nfa)
+        self.prefilter = None if prefilter.is_empty() else prefilter  # finds positions matches can start at
+
+    @staticmethod
+    def supports(nfa):
+        """Returns True if the NFA can be matched by a DFA, i.e. it has no back references and no anchors"""
+        return all(state.state_type not in ["back reference", "anchor"] for state in NFA.reachable_states(nfa))
+
+    def match_all(self, text):
+        """Return list of all non overlapping, leftmost-longest matches of the pattern in the text"""
+        return list(self.finditer(text))
+
+    def finditer(self, text, pos=0, endpos=None):
+        """Generate all non overlapping, leftmost-longest matches of the pattern in the text between pos and endpos,
+        the text is treated as if it ended at endpos"""
+        if endpos is not None and endpos < len(text):
+            text = text[:endpos]
+        dead_states = {}  # position -> DFA states known not to lead to a match end at or after the position
+        next_positions = {}  # occurrences found by the prefilter
+        position = pos
+        while position < len(text):
+            if self.prefilter is not None:
+                candidate = self.prefilter.next_candidate(text, position, next_positions)
+                if candidate < 0:
+                    break
+                if candidate > position:
+                    for skipped_position in [p for p in dead_states if p < candidate]:
+                        del dead_states[skipped_position]
+                    position = candidate
+            end, accepting = self.match_end(text, position, dead_states)
+            if end is not None:
+                match_result = MatchResult(text, position, end, engine=self)
+                match_result.pattern_no = min(accepting)
+                yield match_result
+                for skipped_position in range(position, end):
+                    dead_states.pop(skipped_position, None)
+                position = end
+            else:
+                dead_states.pop(position, None)
+                position += 1
+
+    def match_first(self, text):
+        """Return the first match of the pattern in the text"""
+        return self.match(text, 0)
+
+    def match(self, text, position):
+        """Return the longest match starting at the position, None if there's no match"""
+        end, accepting = self.match_end(text, position, {})
+        if end is None:
+            return None
+        match_result = MatchResult(text, position, end, engine=self)
+        match_result.pattern_no = min(accepting)
+        return match_result
+
+    def find_group_spans(self, text, position):
+        """Returns match group spans of the match at the position, found by the Interpreter"""
+        return self.get_interpreter().match(text, position).group_spans
+
+    def get_interpreter(self):
+        """Returns Interpreter of the NFA, for matching DFA doesn't support"""
+        if self.interpreter is None:
+            self.interpreter = Interpreter(self.nfa)
+        return self.interpreter
+
+    def matching_patterns(self, text):
+        """Search mode only: returns set of pattern_no of all patterns matching the text somewhere"""
+        if self.start_state is None:
+            self.start_state = self.get_start_state()
+        state = self.start_state
+        found = set()
+        for char in text:
+            next_state = state.transitions.get(char)
+            if next_state is None:
+                next_state = self.add_transition(state, char)
+            state = next_state
+            found.update(state.accepting)
+        return found
+
+    def match_end(self, text, position, dead_states):
+        """Runs the DFA from the position, returns end of the longest match or None and pattern_no of patterns
+        matching there.
+        Every DFA state visited after the last match end leads nowhere, it's recorded in dead_states, so later
+        attempts reaching the same state at the same position stop immediately."""
+        if self.start_state is None:
+            self.start_state = self.get_start_state()
+        state = self.start_state
+        start_position = position
+        match_end = None
+        match_accepting = None
+        visited = []
+
+        while True:
+            if state in dead_states.get(position, ()):
+                break
+            if state.accepting and position > start_position:
+                match_end = position
+                match_accepting = state.accepting
+            if position >= len(text) or state.is_dead():
+                break
+            visited.append(state)
+            next_state = state.transitions.get(text[position])
+            if next_state is None:
+                next_state = self.add_transition(state, text[position])
+            state = next_state
+            position += 1
+
+        self.record_dead_states(dead_states, visited, start_position, match_end)
+        return match_end, match_accepting
+
+    @staticmethod
+    def record_dead_states(dead_states, visited, start_position, match_end):
+        """Records states visited after the last match end in dead_states, visited[i] is the state (of any engine
+        running the DFA) at start_position + i"""
+        last_end = start_position if match_end is None else match_end
+        for offset in range(last_end - start_position + 1, len(visited)):
+            dead_states.setdefault(start_position + offset, set()).add(visited[offset])
+
+    def get_start_state(self):
+        """Returns DFA state of the START node"""
+        configs = set()
+        counters = (0,) * self.rec_count
+        if self.nfa.state_type == "repetition":
+            counters = self.nfa.set_counter(counters, 1)
+        accepting = self.enter(self.nfa, counters, configs, set())
+        self.start_configs = frozenset(configs)
+        return self.get_state(configs, frozenset(accepting))
+
+    def add_transition(self, state, char):
+        """Computes the DFA state following the state on the character and caches the transition"""
+        if self.cache_entries >= self.cache_size:
+            self.flush()
+            state = self.get_state(state.configs, state.accepting)
+
+        configs = set()
+        visited = set()
+        accepting = set()
+        for nfa_state, matched_len, counters in state.configs:
+            if nfa_state.state_type in State.literal_types and len(nfa_state.match_values[0]) > 1:
+                literal = nfa_state.match_values[0]
+                if literal[matched_len] != char:
+                    continue
+                if matched_len + 1 < len(literal):
+                    configs.add((nfa_state, matched_len + 1, counters))
+                    continue
+            elif not nfa_state.is_matched(char, 0)[0]:
+                continue
+
+            accepting.update(self.leave(nfa_state, counters, configs, visited))
+
+        if self.search:
+            # a match can start at the next position as well, reaching END from START there is an empty match
+            configs.update(self.start_configs)
+        next_state = self.get_state(configs, frozenset(accepting))
+        state.transitions[char] = next_state
+        self.cache_entries += 1
+        return next_state
+
+    def get_state(self, configs, accepting):
+        """Returns cached DFA state for the set of configurations, creates one if it's not in the cache"""
+        configs = frozenset(configs)
+        state = self.states.get((configs, accepting))
+        if state is None:
+            state = DFAState(configs, accepting)
+            self.states[(configs, accepting)] = state
+            self.cache_entries += 1
+        return state
+
+    def flush(self):
+        """Drops all cached DFA states and transitions"""
+        if self.verbose > 0:
+            print("DFA cache flushed, states: ", len(self.states), ", entries: ", self.cache_entries)
+        for state in self.states.values():
+            state.transitions.clear()
+        self.states = {}
+        self.cache_entries = 0
+        self.start_state = None
+
+    def enter(self, nfa_state, counters, configs, visited):
+        """Adds configurations reachable by entering nfa_state without consuming text.
+        Returns set of pattern_no of END states reached"""
+        key = (nfa_state, counters)
+        if key in visited:
+            return set()
+        visited.add(key)
+
+        if nfa_state.state_type == "end":
+            return {nfa_state.pattern_no}
+        if nfa_state.state_type in LazyDFA.epsilon_types:
+            return self.leave(nfa_state, counters, configs, visited)
+        configs.add((nfa_state, 0, counters))
+        return set()
+
+    def leave(self, nfa_state, counters, configs, visited):
+        """Follows output states of nfa_state, which matched the text. Repetition counters follow the rules of
+        RecurringState.edge_set, enter_counters and exit_counters, as in the Interpreter. Returns set of pattern_no of
+        END states reached"""
+        output_state_list = nfa_state.output_states + nfa_state.loop_back_output_states
+        exit_count = 0  # number of the first output states leaving the repetition
+        if nfa_state.state_type == "repetition":
+            exit_count = len(output_state_list)
+            edge_set = nfa_state.edge_set(counters[nfa_state.rec_no])
+            if edge_set == "loop":
+                output_state_list = nfa_state.loop_output_states
+                exit_count = 0
+            elif edge_set == "all":
+                output_state_list = output_state_list + nfa_state.loop_output_states
+
+        accepting = set()
+        for index, output_state in enumerate(output_state_list):
+            output_counters = counters
+            if index < exit_count:
+                output_counters = nfa_state.exit_counters(output_counters)
+            if output_state.state_type == "repetition":
+                output_counters = output_state.enter_counters(output_counters,
+                                                              output_state in nfa_state.loop_back_output_states)
+                if output_counters is None:
+                    continue
+            accepting.update(self.enter(output_state, output_counters, configs, visited))
+        return accepting
@@ -0,0 +1,225 @@
+"""Differential test of the RegEx Machine engines.
+
+Random patterns and texts are generated (the same for a given seed) and the matches of every engine are compared with
+the matches of the Interpreter of the optimized NFA:
+* unoptimized - Interpreter of the NFA parsed with RegExParser.optimize off
+* dfa - LazyDFA, for patterns it supports
+* bit-parallel - BitParallel, for patterns with few enough positions
+* codegen - CompiledDFA, for patterns it can compile
+* dense - DenseDFA, finditer and match_batch (against Interpreter.match at the start of the texts), needs numpy
+* stream - Interpreter.match_stream, the text is read in chunks of random sizes
+* frontier - the largest number of steps the Interpreter keeps for a position of a long text (the texts joined), it
+  must stay under the bound of Thompson simulation (see frontier_bound), for patterns without back references
+Matches are compared as (start, end, match groups). Mismatches are printed with the pattern and the text, the exit
+status is 1 if any were found.
+
+Usage: python differential.py [--patterns N] [--texts N] [--seed N] [--engine NAME] [--limit N]
+"""
+
+import argparse
+import contextlib
+import io
+import random
+import sys
+
+from regex_parser import RegExParser
+from interpreter import Interpreter
+from state_machine import NFA, State
+from dfa import LazyDFA
+from codegen import CompiledDFA
+from bit_parallel import BitParallel
+from dense_dfa import DenseDFA
+
+engines = ["unoptimized", "dfa", "bit-parallel", "codegen", "dense", "stream", "frontier"]
+
+atoms = ["a", "b", "c", "ab", ".", "[ab]", "[^a]", "[a-c1]", "\\d", "\\w", "\\s", "\\p{Greek}", "\\p{Nd}"]
+quantifiers = ["", "", "", "*", "+", "?", "{2}", "{1,3}", "{,2}", "{2,}"]
+text_chars = "aaabbbc1 xAβ٣\n"
+long_text_length = 2000  # length of the text the frontier is measured on
+
+
+def generate_pattern(rnd, depth=0):
+    """Returns random pattern of atoms, groups, alternations, quantifiers and back references, groups aren't nested
+    to keep the DFAs small"""
+    parts = []
+    groups = 0
+    for _ in range(rnd.randint(1, 3 if depth == 0 else 2)):
+        choice = rnd.random()
+        if choice < 0.25 and depth == 0:
+            alternatives = [generate_pattern(rnd, depth + 1) for _ in range(rnd.randint(1, 3))]
+            part = "(%s)" % "|".join(alternatives)
+            groups += 1
+        elif choice < 0.3 and groups > 0 and depth == 0:
+            part = "\\%d" % rnd.randint(1, groups)
+        else:
+            part = rnd.choice(atoms)
+            if len(part) > 1 and part[0] not in "\\[":
+                part = "(%s)" % part
+                groups += 1
+        parts.append(part + (rnd.choice(quantifiers) if part[0] != "\\" or not part[1].isdigit() else ""))
+    return "".join(parts)
+
+
+def generate_text(rnd):
+    """Returns random text of up to 30 characters"""
+    return "".join(rnd.choice(text_chars) for _ in range(rnd.randint(0, 30)))
+
+
+def parse(pattern, optimize):
+    """Returns NFA of the pattern, None if it can't be parsed"""
+    parser = RegExParser(pattern)
+    parser.optimize = optimize
+    with contextlib.redirect_stdout(io.StringIO()):
+        ok, nfa = parser.parse()
+    return nfa if ok else None
+
+
+def match_keys(match_results):
+    """Returns list of (start, end, groups) of the matches, None stays None"""
+    return [None if match_result is None else (match_result.position, match_result.end, match_result.groups())
+            for match_result in match_results]
+
+
+def chunked(text, rnd):
+    """Generates the text in chunks of random sizes"""
+    position = 0
+    while position < len(text):
+        size = rnd.randint(1, 8)
+        yield text[position:position + size]
+        position += size
+
+
+def frontier_bound(nfa):
+    """Returns the largest number of steps the Interpreter may keep for a position of a pattern without back
+    references. Steps of a state differ only in counters of the repetitions enclosing the state (the others are 0),
+    for every combination of the counters there is a step per position the step was created at"""
+    states = NFA.reachable_states(nfa)
+    combinations = {state: 1 for state in states}
+    for repetition in states:
+        if repetition.state_type != "repetition":
+            continue
+        # values of the counter, see RecurringState.enter_counters and saturate
+        values = repetition.min_rep + 1 if repetition.max_rep >= 999999 else repetition.max_rep + 1
+        enclosed = {repetition}
+        stack = list(repetition.loop_output_states)
+        while len(stack) > 0:
+            state = stack.pop()
+            if state not in enclosed:
+                enclosed.add(state)
+                stack.extend(NFA.output_states(state))
+        for state in enclosed:
+            combinations[state] *= values
+    longest = max([len(state.match_values[0]) for state in states if state.state_type in State.literal_types] + [1])
+    return sum(combinations.values()) * longest
+
+
+def peak_frontier(nfa, text):
+    """Returns the largest number of steps the Interpreter kept for a position of the text"""
+    interpreter = Interpreter(nfa)
+    interpreter.enable_stats()
+    interpreter.match_all(text)
+    return interpreter.stats.peak_frontier
+
+
+def make_matcher(engine, pattern, nfa, rnd):
+    """Returns function list of texts -> list of results compared with the reference, None if the engine can't match
+    the pattern"""
+    if engine == "unoptimized":
+        unoptimized = parse(pattern, False)
+        if unoptimized is None:
+            return None
+        matcher = Interpreter(unoptimized)
+    elif engine == "frontier":
+        if Interpreter(nfa).has_back_references:
+            return None
+        bound = frontier_bound(nfa)
+
+        def frontier(texts):
+            text = "".join(texts) or "a"
+            peak = peak_frontier(nfa, text * (long_text_length // len(text) + 1))
+            return ["peak frontier <= %d" % bound if peak <= bound else "peak frontier %d" % peak]
+        return frontier
+    elif engine == "stream":
+        interpreter = Interpreter(nfa)
+        return lambda texts: [match_keys(interpreter.match_stream(chunked(text, rnd))) for text in texts]
+    elif engine == "dfa":
+        matcher = LazyDFA(nfa) if LazyDFA.supports(nfa) else None
+    elif engine == "bit-parallel":
+        matcher = BitParallel.compile(nfa)
+    elif engine == "codegen":
+        matcher = CompiledDFA.compile(nfa, pattern)
+    else:
+        dense = DenseDFA.compile(nfa, pattern)
+        if dense is None:
+            return None
+        return lambda texts: [match_keys(dense.match_all(text)) for text in texts] + \
+            [match_keys(dense.match_batch(texts))]
+    if matcher is None:
+        return None
+    return lambda texts: [match_keys(matcher.match_all(text)) for text in texts]
+
+
+def reference_results(engine, nfa, texts):
+    """Returns results of the Interpreter the results of the engine are compared with"""
+    if engine == "frontier":
+        return ["peak frontier <= %d" % frontier_bound(nfa)]
+    interpreter = Interpreter(nfa)
+    results = [match_keys(interpreter.match_all(text)) for text in texts]
+    if engine == "dense":
+        results.append(match_keys(interpreter.match(text, 0) for text in texts))
+    return results
+
+
+def compare(pattern_count, text_count, seed, selected_engines, limit):
+    """Matches generated patterns by the engines, prints the mismatches, returns (number of mismatches, dict engine ->
+    number of patterns compared)"""
+    rnd = random.Random(seed)
+    mismatches = 0
+    compared = {engine: 0 for engine in selected_engines}
+    for _ in range(pattern_count):
+        pattern = generate_pattern(rnd)
+        texts = [generate_text(rnd) for _ in range(text_count)]
+        nfa = parse(pattern, True)
+        if nfa is None:
+            continue
+        for engine in selected_engines:
+            matcher = make_matcher(engine, pattern, nfa, rnd)
+            if matcher is None:
+                continue
+            compared[engine] += 1
+            expected = reference_results(engine, nfa, texts)
+            found = matcher(texts)
+            for index, (expected_keys, found_keys) in enumerate(zip(expected, found)):
+                if expected_keys == found_keys:
+                    continue
+                mismatches += 1
+                if mismatches <= limit:
+                    if engine == "frontier":
+                        text = "<texts joined>"
+                    elif index < len(texts):
+                        text = texts[index]
+                    else:
+                        text = "<match_batch>"
+                    print("%s %r %r\n  expected %s\n  found    %s" % (engine, pattern, text, expected_keys,
+                                                                      found_keys))
+    return mismatches, compared
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Differential test of the RegEx Machine engines")
+    parser.add_argument("--patterns", type=int, default=300, help="number of generated patterns")
+    parser.add_argument("--texts", type=int, default=20, help="number of generated texts per pattern")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the pattern and text generator")
+    parser.add_argument("--engine", action="append", choices=engines, help="engine to compare")
+    parser.add_argument("--limit", type=int, default=20, help="number of mismatches printed")
+    args = parser.parse_args()
+
+    mismatches, compared = compare(args.patterns, args.texts, args.seed, args.engine or engines, args.limit)
+    for engine, count in compared.items():
+        print("%-12s %5d patterns" % (engine, count))
+    print("mismatches: %d" % mismatches)
+    sys.exit(1 if mismatches > 0 else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,9 @@
+import heapq
+
+from state_machine import NFA, State
+from prefilter import Prefilter
+
+
 class Step:
     """Each matching state generates a step, this class represent it"""
     def __init__(self, state, position, match_len, text, prev_step, step_no):
@@ -26,29 +32,191 @@ class Step:
         return "(" + self.state.state_label + ")" + matched_text
 
 
-class MatchResult:
-    """The result of match method, contains position in text, matched text and list of all steps leading to the match"""
-    def __init__(self, position, matched_text, step_list):
-        self.position = position
-        self.matched_text = matched_text
-        self.step_list = step_list
-
-    @classmethod
-    def from_steps(cls, last_step):
-        """Initialize w MatchResult object from a list of steps found by match method"""
-        s = last_step
-
-        out_string = s.matched_text()
-        out_steps = [s]
+class ThreadArena:
+    """Storage of the interpreter's steps. Steps are kept in preallocated parallel lists and referred to with integer
+    ids, the list of a field is indexed with the step id, e.g. arena.position[step].
+    Each step counts references to it: one for the frontier (released once the step is processed) and one for every
+    step it is the previous step of. A step with no references is freed and its id is reused, this way only steps
+    of live threads are kept. Steps are linked with their previous steps only if keep_steps is set, otherwise
+    a thread holds just its last step.
+    The arena keeps all the state of a single scan, so scans of the same Interpreter can run interleaved.
+    """
 
-        while s.prev_step is not None:
-            s = s.prev_step
-            out_string = s.matched_text() + out_string
-            out_steps = [s] + out_steps
+    def __init__(self, state_count, keep_steps, capacity=256):
+        self.keep_steps = keep_steps
+        self.base = 0  # offset of the text being scanned in the whole text
+
+        # frontier of the current position, a sparse set indexed with state_no: a state is on the frontier if its
+        # frontier_generation is the current generation, frontier_keys holds the state's steps, dict (counters, start)
+        # -> start position of the thread the step belongs to
+        self.generation = 0
+        self.frontier_generation = [-1] * state_count
+        self.frontier_keys = [None] * state_count
+        self.overtaken = {}  # start position of a thread -> the earliest start of threads its steps were dropped for
+
+        self.state = []
+        self.position = []  # position in text, the beginning of the string to be matched
+        self.match_len = []
+        self.prev = []  # id of the previous step, -1 for the first step of a thread
+        self.start_position = []  # position the whole match (thread) has started at
+        self.rep_counters = []  # most recent counter of every recurrent state, indexed with RecurringState.rec_no
+        self.group_starts = []  # start of the last opened match groups, indexed with group number, -1 if not opened
+        self.group_spans = []  # (start, end) of the last closed match groups, indexed with group number, None if not
+        self.ref_count = []
+        self.free_steps = []
+        self.grow(capacity)
+
+    def grow(self, size):
+        """Adds size free steps to the arena"""
+        capacity = len(self.state)
+        for field in [self.state, self.rep_counters, self.group_starts, self.group_spans]:
+            field.extend([None] * size)
+        for field in [self.position, self.match_len, self.prev, self.start_position, self.ref_count]:
+            field.extend([0] * size)
+        self.free_steps.extend(range(capacity + size - 1, capacity - 1, -1))
+
+    def add(self, state, position, match_len, prev, rep_counters, group_starts, group_spans):
+        """Returns id of a new step, referenced once (by the caller). Group tuples are shared until changed"""
+        if len(self.free_steps) == 0:
+            self.grow(len(self.state))
+        step = self.free_steps.pop()
+
+        self.state[step] = state
+        self.position[step] = position
+        self.match_len[step] = match_len
+        self.prev[step] = prev
+        self.rep_counters[step] = rep_counters
+        self.group_starts[step] = group_starts
+        self.group_spans[step] = group_spans
+        self.ref_count[step] = 1
+        if prev < 0:
+            self.start_position[step] = position
+        else:
+            self.start_position[step] = self.start_position[prev]
+            if self.keep_steps:
+                self.ref_count[prev] += 1
+            else:
+                self.prev[step] = -1
+        return step
+
+    def release(self, step):
+        """Drops a reference to the step, frees the step and previous steps no longer referenced by any step"""
+        while step >= 0:
+            self.ref_count[step] -= 1
+            if self.ref_count[step] > 0:
+                return
+            self.state[step] = None
+            self.rep_counters[step] = None
+            self.group_starts[step] = None
+            self.group_spans[step] = None
+            self.free_steps.append(step)
+            step = self.prev[step]
+
+    def matched_text(self, step, text, base=0):
+        """Returns the text matched at the step, base is offset of the text"""
+        return text[self.position[step] - base:self.position[step] - base + self.match_len[step]]
+
+    def to_steps(self, step, text):
+        """Returns list of Step objects of the step and all its previous steps, in the order of matching"""
+        step_ids = []
+        while step >= 0:
+            step_ids.append(step)
+            step = self.prev[step]
+
+        step_list = []
+        prev_step = None
+        for step_no, step in enumerate(reversed(step_ids)):
+            prev_step = Step(self.state[step], self.position[step], self.match_len[step], text, prev_step, step_no)
+            if self.state[step].state_type == "repetition":
+                prev_step.rep_counter = self.rep_counters[step][self.state[step].rec_no]
+            for match_group in self.state[step].match_group_end:
+                start, end = self.group_spans[step][match_group]
+                prev_step.back_ref_text = text[start:end]
+            step_list.append(prev_step)
+        return step_list
+
+
+class InterpreterStats:
+    """Counters of the Interpreter's hot path, collected only if enabled (see Interpreter.enable_stats)"""
+
+    def __init__(self):
+        self.steps_created = 0
+        self.peak_frontier = 0  # the largest number of steps waiting for a text position
+        self.dedup_rejections = 0  # steps not created, an equivalent step was at the position already (add_to_list)
+        self.rescans = 0  # scans restarted at a match end, see Interpreter.lost_threads
+        self.is_matched_calls = {}  # state type -> number of is_matched calls
+        self.positions_tried = 0  # positions a thread was started at
+        self.positions_skipped = 0  # positions skipped by the prefilter
+        self.matches = 0
+
+    def to_dict(self):
+        return {
+            "steps_created": self.steps_created,
+            "peak_frontier": self.peak_frontier,
+            "dedup_rejections": self.dedup_rejections,
+            "rescans": self.rescans,
+            "is_matched_calls": dict(self.is_matched_calls),
+            "positions_tried": self.positions_tried,
+            "positions_skipped": self.positions_skipped,
+            "matches": self.matches,
+        }
 
-        ret = cls(s.position, out_string, out_steps)
 
-        return ret
+class MatchResult:
+    """The result of match method, contains position of the match in text and, if the Interpreter keeps steps,
+    list of all steps leading to the match.
+    Match groups are kept as (start, end) offsets, matched text and groups are sliced from the text on demand.
+    The text can be a part of the whole text, starting at offset, offsets of the match and groups are absolute"""
+    def __init__(self, text, position, end, group_spans=None, step_list=None, engine=None, offset=0):
+        self.text = text
+        self.offset = offset
+        self.position = position
+        self.end = end
+        self.group_spans = group_spans  # indexed with group number: (start, end) or None if the group didn't match
+        self.step_list = step_list if step_list is not None else []
+        self.engine = engine  # engine computing group_spans on demand, used if they weren't recorded by matching
+        self.pattern_no = 0  # number of the matched pattern, for matches of a pattern set
+        self.group_count = None  # number of match groups of the matched pattern of a set, None: all group spans
+
+    @property
+    def matched_text(self):
+        return self.text[self.position - self.offset:self.end - self.offset]
+
+    def span(self, group_no=0):
+        """Returns (start, end) of the match group, (-1, -1) if the group didn't match, group 0 is the whole match"""
+        if group_no == 0:
+            return self.position, self.end
+        group_spans = self.get_group_spans()
+        if not 0 < group_no <= self.get_group_count():
+            raise IndexError("no such group: " + str(group_no))
+        if group_spans[group_no] is None:
+            return -1, -1
+        return group_spans[group_no]
+
+    def group(self, group_no=0):
+        """Returns text matched by the match group, None if the group didn't match, group 0 is the whole match"""
+        start, end = self.span(group_no)
+        if start < 0:
+            return None
+        return self.text[start - self.offset:end - self.offset]
+
+    def groups(self):
+        """Returns tuple of texts matched by all match groups, None for the groups which didn't match"""
+        return tuple(self.group(group_no) for group_no in range(1, self.get_group_count() + 1))
+
+    def get_group_count(self):
+        """Returns number of match groups of the matched pattern"""
+        if self.group_count is not None:
+            return self.group_count
+        return len(self.get_group_spans()) - 1
+
+    def get_group_spans(self):
+        if self.group_spans is None:
+            if self.engine is None:
+                self.group_spans = (None,)
+            else:
+                self.group_spans = self.engine.find_group_spans(self.text, self.position)
+        return self.group_spans
 
     def to_string(self):
         """Returns a string containing important information about the match result"""
@@ -57,227 +225,447 @@ class MatchResult:
 
 class Interpreter:
     """Interpreter class performs matching, has 2 main methods:
-    * match(position), tries to match a pattern at a position
-    * run(), performs match at every position of the input text
+    * match(text, position), tries to match a pattern at a position
+    * match_all(text), finds all non overlapping matches in a single pass over the text
+    and finditer(text, pos, endpos), generating the matches of match_all one by one.
+    Steps of the matching are kept in a ThreadArena. Steps are created only for states reading text and END, the
+    states between them are passed through (see next_steps), their edges are precomputed (see build_edges).
     """
+
+    pass_through_types = ["expression", "repetition"]  # states always matching without reading text
+
     def __init__(self, nfa):
         self.nfa = nfa
-        # self.text = text
-        self.next_turn = []
-        self.current_turn = []
-        self.matches = []  # list of tuples (start_pos, end_pos)
         self.verbose = 0
+        states = NFA.reachable_states(nfa)
+        # number of recurrent states, i.e. length of the repetition counter vector carried by steps
+        self.rec_count = max([state.rec_no + 1 for state in states if state.state_type == "repetition"], default=0)
+        # number of match group slots in group_starts and group_spans, match groups are numbered from 1
+        self.group_count = max([group + 1 for state in states for group in state.match_group_start], default=1)
+        # with back references steps from different start positions aren't equivalent, even in the same state
+        self.has_back_references = any(state.state_type == "back reference" for state in states)
+        # number of characters states look at from a position, a back reference looks at up to the number of
+        # characters its thread matched so far on top of that
+        self.lookahead = self.find_lookahead(states)
+        self.state_count = max(state.state_no for state in states) + 1  # states are numbered by the parser
+        self.build_edges(states)
+        self.keep_steps = False  # if set, match results get step_list, list of all steps leading to the match
+        self.stats = None  # InterpreterStats, if set the scans count their work in it, see enable_stats
+        prefilter = Prefilter(nfa)
+        self.prefilter = None if prefilter.is_empty() else prefilter  # finds positions matches can start at
+
+    def enable_stats(self, enabled=True):
+        """Starts collecting statistics of the matching in new InterpreterStats, or stops collecting them"""
+        self.stats = InterpreterStats() if enabled else None
 
     def match_all(self, text):
-        """Loop over the text and call Interperter.match() for every character of the text"""
-        match_list = []
-        max_reached_position = 0
-        while max_reached_position < len(text):
-            ret = self.match(text, max_reached_position)
-            if ret is not None:
-                max_reached_position = ret.position + len(ret.matched_text)
-                match_list += [ret]
-            else:
-                max_reached_position += 1
+        """Return list of all non overlapping, leftmost-longest matches of the pattern in the text"""
+        return list(self.scan(text, 0, True))
 
-        return match_list
+    def finditer(self, text, pos=0, endpos=None):
+        """Generate all non overlapping, leftmost-longest matches of the pattern in the text between pos and endpos,
+        the text is treated as if it ended at endpos"""
+        if endpos is not None and endpos < len(text):
+            text = text[:endpos]
+        return self.scan(text, pos, True)
 
     def match_first(self, text):
         """Return the first match of the pattern in the text"""
         return self.match(text, 0)
 
+    def match_stream(self, chunks):
+        """Generate all non overlapping, leftmost-longest matches of the pattern in the text read in chunks,
+        see scan for details"""
+        return self.scan("", 0, True, chunks)
 
-    @staticmethod
-    def get_rep_counter(last_step, rec_state_label):
-        """Return number of recurrences of the same label (ID) in the step list leading up to last_step
-        inclusive the last step"""
-
-        s = last_step
-
-        if s is not None and s.state.state_label == rec_state_label:
-            return s.rep_counter
-
-        while s.prev_step is not None:
-            s = s.prev_step
-
-            if s is not None and s.state.state_label == rec_state_label:
-                return s.rep_counter
-
-        return 1
+    def match(self, text, position):
+        """Return the longest match starting at the position, None if there's no match"""
+        for match_result in self.scan(text, position, False):
+            return match_result
+        return None
 
-    @staticmethod
-    def can_go_recurrent(current_step, new_state_label):
-        """Check if there's a cycle in the NFA, by looking into cyclical references of recurrent nodes without
-        any matching characters between them"""
+    def scan(self, text, position, find_all, chunks=None):
+        """Generate leftmost-longest matches found in a single pass over the text, starting at the position.
+        Algorithm (Thompson simulation): steps are kept in buckets by the text position they continue at.
+        At every position:
+        - if find_all is set, a new thread is started with the START node
+        - steps waiting for the position are processed in order of their start position (leftmost first),
+          every output state that returned is_matched = True creates a new step, steps that didn't consume any
+          text are processed at the same position, the others wait for the position they end at
+        - if current step is END -> record match, always keep the longest match for every start position
+        - a match is reported once no thread started at the same or earlier position is alive
+        If find_all is not set, only one thread is started at the position and the first match is the result.
+        If no thread is alive, the scan jumps to the next position a match can start at (see Prefilter).
+        If chunks (an iterator of strings) is given, text is read from it: position is processed once all characters
+        states may look at from it were read, before that the next chunk is appended to the text. Text before
+        the earliest position used by alive threads is dropped then, positions stay absolute (arena.base is offset
+        of the text).
+        Steps equivalent to steps of an earlier thread are dropped (see add_to_list). If the earlier thread is dropped
+        by a match ending at or before the start of the later one, the scan is restarted at the end of the match.
+        """
+        arena = ThreadArena(self.state_count, self.keep_steps)
+        base = 0
+        pending = {}  # position -> list of (start position, sequence no, step) waiting for the position
+        candidates = {}  # start position -> END step of the longest match found so far
+        leftmost = None  # the lowest start position in candidates
+        first_position = position
+        committed_position = position  # end of the last reported match, threads started before it are dropped
+        sequence_no = 0
+        next_positions = {}  # occurrences found by the prefilter
+        stats = self.stats
+
+        margin = self.lookahead
+        while True:
+            if chunks is not None and self.has_back_references:
+                thread_starts = [thread[0] for threads in pending.values() for thread in threads]
+                margin = max([self.lookahead] + [position - start for start in thread_starts])
+            if chunks is not None and position + margin > base + len(text):
+                chunk = next(chunks, "")
+                if len(chunk) == 0:
+                    chunks = None
+                    continue
+                # keep the text from the earliest position used by alive threads, and the character before it
+                thread_starts = [thread[0] for threads in pending.values() for thread in threads]
+                keep_position = max(base, min([position] + thread_starts + list(candidates)) - 1)
+                text = text[keep_position - base:] + chunk
+                base = arena.base = keep_position
+                next_positions = {}
+                continue
+            if position > base + len(text):
+                return
+
+            if find_all and self.prefilter is not None and len(pending) == 0:
+                candidate = self.prefilter.next_candidate(text, position - base, next_positions, chunks is None)
+                if candidate < 0 and chunks is None:
+                    return
+                if candidate < 0:
+                    # no candidate in the text read so far, skip to the position needing the next chunk
+                    position = max(position, base + len(text) - margin + 1)
+                    continue
+                if stats is not None:
+                    stats.positions_skipped += base + candidate - position
+                position = base + candidate
+                if chunks is not None and position + margin > base + len(text):
+                    continue
 
-        s = current_step
+            current_state_list = pending.pop(position, [])
+            heapq.heapify(current_state_list)
+            if stats is not None:
+                stats.peak_frontier = max(stats.peak_frontier, len(current_state_list))
+            arena.generation += 1  # clears the frontier, i.e. the steps created at the position
+
+            # a new thread starts once the threads waiting for the position are processed, it has the lowest priority
+            started = not ((find_all and position < base + len(text)) or position == first_position)
+            if not started and self.prefilter is not None and self.prefilter.start_anchor is not None:
+                started = not self.prefilter.can_start_at(text, position - base)
+
+            while len(current_state_list) > 0 or not started:
+                if len(current_state_list) == 0:
+                    started = True
+                    step = self.start_step(arena, text, position)
+                    if step >= 0:
+                        self.push_step(arena, step, sequence_no, current_state_list, pending)
+                        sequence_no += 1
+                    continue
 
-        while s.prev_step is not None:
-            s = s.prev_step
+                start_position, _, current_step = heapq.heappop(current_state_list)
 
-            if s.state.state_type not in ["recurrence", "expression"]:
-                return True
+                # threads started before the last match or inside a longer match from an earlier position are dropped
+                if start_position < committed_position or \
+                        (leftmost is not None and leftmost < start_position < arena.position[candidates[leftmost]]):
+                    arena.release(current_step)
+                    continue
 
-            if s.state.state_label == new_state_label:
-                return False
+                if self.verbose > 1:
+                    print("State: ", arena.state[current_step].state_type, " ", arena.state[current_step].state_label)
+                    print("Match: ", arena.matched_text(current_step, text, base))
+
+                # match found, record it and move on
+                if arena.state[current_step].state_type == "end":
+                    if arena.position[current_step] > start_position and \
+                            (start_position not in candidates
+                             or self.is_better_match(arena, current_step, candidates[start_position])):
+                        if start_position in candidates:
+                            arena.release(candidates[start_position])
+                        candidates[start_position] = current_step
+                        if leftmost is None or start_position < leftmost:
+                            leftmost = start_position
+                    else:
+                        arena.release(current_step)
+                    continue
 
-        return True
+                for step in self.next_steps(arena, text, current_step):
+                    self.push_step(arena, step, sequence_no, current_state_list, pending)
+                    sequence_no += 1
+                arena.release(current_step)
+
+            # report matches, which can't be overtaken by a thread started earlier
+            rescan = False
+            while leftmost is not None:
+                if any(committed_position <= thread[0] <= leftmost for threads in pending.values() for thread in threads):
+                    break
+                match_start = leftmost
+                end_step = candidates.pop(match_start)
+                committed_position = arena.position[end_step]
+                for start_position in [s for s in candidates if s < committed_position]:
+                    arena.release(candidates.pop(start_position))
+                leftmost = min(candidates) if len(candidates) > 0 else None
+                if base == 0 and chunks is None and self.keep_steps:
+                    match_result = MatchResult(text, match_start, committed_position, arena.group_spans[end_step],
+                                               arena.to_steps(end_step, text))
+                elif base == 0 and chunks is None:
+                    match_result = MatchResult(text, match_start, committed_position, arena.group_spans[end_step])
+                else:
+                    # text read in chunks doesn't outlive the scan, the result gets its own copy of the matched text
+                    match_result = MatchResult(text[match_start - base:committed_position - base], match_start,
+                                               committed_position, arena.group_spans[end_step], offset=match_start)
+                match_result.pattern_no = arena.state[end_step].pattern_no
+                arena.release(end_step)
+                if stats is not None:
+                    stats.matches += 1
+                yield match_result
+                if not find_all:
+                    return
+                if self.lost_threads(arena, committed_position):
+                    rescan = True
+                    break
+
+            if not find_all and len(pending) == 0:
+                return
+
+            if rescan:
+                # threads started after the match lost steps to dropped threads, they are started again
+                for threads in pending.values():
+                    for _, _, step in threads:
+                        arena.release(step)
+                for step in candidates.values():
+                    arena.release(step)
+                pending = {}
+                candidates = {}
+                leftmost = None
+                next_positions = {}
+                arena.overtaken.clear()
+                if stats is not None:
+                    stats.rescans += 1
+                position = committed_position
+                continue
 
-    def match(self, text, position):
-        """Return matching string starting at the position
-        Algorithm: start with node START, create a list current_state_list = [START], this list will contain steps
-        to be processed current turn
-        Iterate over output_states of each node from current_state_list:
-        - put every state that returned is_matched = True on the next_state_list step list
-        - once current_state_list is empty, swap current end next lists
-        - if current step is END -> record match, always keep the longest match
-        - if text is over or both current and next lists are empty, end loop
-        """
+            position += 1
 
-        max_position_reached = position
-        max_match_step = None
+    @staticmethod
+    def is_better_match(arena, end_step, other_end_step):
+        """Returns True if the END step ends a longer match than the other END step of the same start position,
+        or a match of the same length of a pattern with lower pattern_no (in a pattern set)"""
+        if arena.position[end_step] != arena.position[other_end_step]:
+            return arena.position[end_step] > arena.position[other_end_step]
+        return arena.state[end_step].pattern_no < arena.state[other_end_step].pattern_no
 
-        matched, match_len = self.nfa.is_matched(text, position)
+    @staticmethod
+    def lost_threads(arena, committed_position):
+        """Returns True if steps of a thread started at or after the end of the committed match were dropped for
+        steps of a thread started before it, which is dropped now. Threads started before the end are forgotten"""
+        lost = False
+        for start_position, holder_start in list(arena.overtaken.items()):
+            if start_position < committed_position:
+                del arena.overtaken[start_position]
+            elif holder_start < committed_position:
+                lost = True
+        return lost
+
+    def start_step(self, arena, text, position):
+        """Returns the first step of a thread starting at the position or -1 if the START node doesn't match"""
+        matched, match_len = self.nfa.is_matched(text, position - arena.base)
+        if self.stats is not None:
+            self.stats.positions_tried += 1
+            self.count_is_matched(self.nfa)
 
         # check if the first node matched, if not, no match at all
         if not matched:
             if self.verbose > 1:
                 print("No match at position ", position)
-            return None
-
-        step = Step(self.nfa, position, match_len, text, None, 0)
-        self.define_match_groups(step)
-        current_state_list = [step]
-        next_state_list = []
+            return -1
 
-        # step_count = 1
+        rep_counters = (0,) * self.rec_count
+        if self.nfa.state_type == "repetition":
+            rep_counters = self.nfa.set_counter(rep_counters, 1)
+        if not self.add_to_list(arena, self.nfa, rep_counters, position):
+            return -1
 
-        while len(current_state_list) > 0 or len(next_state_list) > 0:
-            if len(current_state_list) == 0:
-                # step_count = len(next_state_list)
-                # print("step cnt: ", step_count)
-                # print("pos: ", current_step.position)
+        step = arena.add(self.nfa, position, match_len, -1, rep_counters, (-1,) * self.group_count,
+                         (None,) * self.group_count)
+        self.define_match_groups(arena, step)
+        if self.stats is not None:
+            self.stats.steps_created += 1
+        return step
 
-                current_state_list = next_state_list
-                next_state_list = []
-
-            current_step = current_state_list.pop(0)
+    @staticmethod
+    def push_step(arena, step, sequence_no, current_state_list, pending):
+        """Steps not consuming text continue at the current position, the others wait for the position they end at"""
+        entry = (arena.start_position[step], sequence_no, step)
+        if arena.match_len[step] == 0:
+            heapq.heappush(current_state_list, entry)
+        else:
+            pending.setdefault(arena.position[step] + arena.match_len[step], []).append(entry)
+
+    def next_steps(self, arena, text, current_step):
+        """Returns list of steps created from current step's output states, which match text at the position.
+        Steps are created only for states reading text and END: states matching without reading (alternations,
+        repetitions, anchors) are passed through, their output states are followed at the same position, i.e. the
+        epsilon closure is computed in place, on a queue of (state, repetition counters, group starts, group spans)"""
+        ret = []
+        position = arena.position[current_step] + arena.match_len[current_step]
+        text_position = position - arena.base
+        start_position = arena.start_position[current_step]
+        stats = self.stats
+        closure = [(arena.state[current_step], arena.rep_counters[current_step], arena.group_starts[current_step],
+                    arena.group_spans[current_step])]
+        for current_state, current_counters, group_starts, group_spans in closure:
+            for output_state, is_loop_back, is_exit in self.output_edges(current_state, current_counters):
+                # check if output state matches text at a position, alternations and repetitions always match
+                if output_state.state_type in Interpreter.pass_through_types:
+                    matched, new_match_len = True, 0
+                elif output_state.state_type == "back reference":
+                    if stats is not None:
+                        self.count_is_matched(output_state)
+                    reference = self.get_back_ref_text(arena, group_spans, int(output_state.ref_no), text)
+                    matched, new_match_len = output_state.is_matched(text, text_position, reference)
+                else:
+                    if stats is not None:
+                        self.count_is_matched(output_state)
+                    matched, new_match_len = output_state.is_matched(text, text_position)
+                if not matched:
+                    continue
 
-            if self.verbose > 1:
-                print("State: ", current_step.state.state_type, " ", current_step.state.state_label)
-                print("Match: ", text[current_step.position:current_step.position + current_step.match_len])
-
-            # match found, record it and move on
-            if current_step.state.state_type == "end":
-                # to avoid duplicates in the match_list, check if the match is already there
-                # if current_step.position not in match_list:
-                if max_position_reached < current_step.position:
-                    max_position_reached = current_step.position
-                    max_match_step = current_step
-                continue
+                # clear counter of the repetition left, update repetition counter if came here via
+                # loop_back_output_state (i.e. from within the loop)
+                rep_counters = current_counters
+                if is_exit:
+                    rep_counters = current_state.exit_counters(rep_counters)
+                if output_state.state_type == "repetition":
+                    rep_counters = output_state.enter_counters(rep_counters, is_loop_back)
+                    if rep_counters is None:
+                        continue
 
-            # prepare list of current state's output states, to append it (if they match) to the next step list
-            output_state_list = current_step.state.output_states + current_step.state.loop_back_output_states
-            if current_step.state.state_type == "repetition":
-                rep_counter = self.get_rep_counter(current_step, current_step.state.state_label)
-
-                # if the min loop counter wasn't reached, allow only looping back for next repetition
-                if rep_counter < current_step.state.min_rep + 1:
-                    output_state_list = current_step.state.loop_output_states
-                # if max loop counter wasn't reached, allow looping back for next repetition along with going forward
-                elif rep_counter <= current_step.state.max_rep + 1:
-                    output_state_list += current_step.state.loop_output_states
-
-            for output_state in output_state_list:
-                # check if the step is already on the list
-                if not self.add_to_list(current_step, output_state, next_state_list):
+                # check if an equivalent step is already on the list, this also stops cycles of recurrent states
+                # without char matching: going around such a cycle leads to the same state with the same counters
+                if not self.add_to_list(arena, output_state, rep_counters, start_position):
                     continue
 
-                # check for recurrence cycles without char matching
-                if current_step.state.state_type == "repetition" and output_state.state_type == "repetition":
-                    if not self.can_go_recurrent(current_step, output_state.state_label):
-                        continue
+                if new_match_len == 0 and output_state.state_type != "end":
+                    closure.append((output_state, rep_counters) +
+                                   self.match_groups(output_state, position, 0, start_position, group_starts,
+                                                     group_spans))
+                    continue
+                step = arena.add(output_state, position, new_match_len, current_step, rep_counters, group_starts,
+                                 group_spans)
+                self.define_match_groups(arena, step)
+                ret.append(step)
+        if stats is not None:
+            stats.steps_created += len(ret)
+        return ret
 
-                # check if output state matches text at a position, first check if the state is a back reference
-                if output_state.state_type == "back reference":
-                    reference = self.get_back_ref_text(int(output_state.ref_no), current_step)
-                    matched, new_match_len = output_state.is_matched(text,
-                                                                     current_step.position + current_step.match_len,
-                                                                     reference)
-                # check for the types of state
-                else:
-                    matched, new_match_len = output_state.is_matched(text,
-                                                                     current_step.position + current_step.match_len)
-                if matched:
-                    step = Step(
-                        output_state,
-                        current_step.position + current_step.match_len,
-                        new_match_len,
-                        text,
-                        current_step,
-                        current_step.step_no + 1
-                    )
-
-                    # update repetition counter if came here via loop_back_output_state (i.e. from within the loop)
-                    if output_state.state_type == "repetition":
-                        if output_state not in current_step.state.loop_back_output_states:
-                            # reset output_state's counter
-                            step.rep_counter = 1
-                        else:
-                            rep_counter = self.get_rep_counter(current_step, output_state.state_label)
-                            if rep_counter > output_state.max_rep:
-                                continue
-                            step.rep_counter = rep_counter + 1
-
-                    next_state_list.append(step)
-                    self.define_match_groups(step)
-        if max_match_step is None:
-            return None
-        return MatchResult.from_steps(max_match_step)
-        # return list(match_list.values())
+    def output_edges(self, state, rep_counters):
+        """Returns list of (output state, True if it's a loop back edge, True if it leaves a repetition) of the state,
+        see build_edges and RecurringState.edge_set"""
+        if state.state_type != "repetition":
+            return self.edges[state.state_no]
+        edge_set = state.edge_set(rep_counters[state.rec_no])
+        if edge_set == "loop":
+            return self.loop_edges[state.state_no]
+        if edge_set == "all":
+            return self.all_edges[state.state_no]
+        return self.edges[state.state_no]
+
+    def build_edges(self, states):
+        """Builds the edge tables, lists indexed by state_no of lists of (output state, is loop back edge, is exit edge
+        of a repetition):
+        * edges - output states and loop back output states
+        * loop_edges - loop output states of repetitions
+        * all_edges - both of them, edges of repetitions with counters between min and max"""
+        self.edges = [[] for _ in range(self.state_count)]
+        self.loop_edges = [[] for _ in range(self.state_count)]
+        self.all_edges = [[] for _ in range(self.state_count)]
+        for state in states:
+            output_states = (state.output_states or []) + state.loop_back_output_states
+            is_exit = state.state_type == "repetition"
+            self.edges[state.state_no] = [(output_state, output_state in state.loop_back_output_states, is_exit)
+                                          for output_state in output_states]
+            if state.state_type == "repetition":
+                self.loop_edges[state.state_no] = [(output_state, output_state in state.loop_back_output_states,
+                                                    False) for output_state in state.loop_output_states]
+            self.all_edges[state.state_no] = self.edges[state.state_no] + self.loop_edges[state.state_no]
+
+    def count_is_matched(self, state):
+        """Counts is_matched call of the state in the stats"""
+        calls = self.stats.is_matched_calls
+        calls[state.state_type] = calls.get(state.state_type, 0) + 1
 
-    def define_match_groups(self, step):
-        """Record text matched by a match group in a step"""
-        # match groups
-        if step.state.match_group_end is not []:  # add all match end states to nfa.match_groups
-            for match_group in step.state.match_group_end:
-                match_text = self.find_match_text(match_group, step)
+    @staticmethod
+    def define_match_groups(arena, step):
+        """Record offsets of match groups starting and ending at the step, the step gets its own copy of the tuples"""
+        arena.group_starts[step], arena.group_spans[step] = Interpreter.match_groups(
+            arena.state[step], arena.position[step], arena.match_len[step], arena.start_position[step],
+            arena.group_starts[step], arena.group_spans[step])
 
-                if len(match_text) > 0:
-                    # print("match text for group: ", match_group, " = ", match_text)
-                    # if match text is not empty, save it in the current step
-                    step.back_ref_text = match_text
+    @staticmethod
+    def match_groups(state, position, match_len, start_position, group_starts, group_spans):
+        """Returns (group starts, group spans) updated with match groups starting and ending at the state matched at
+        the position, tuples are copied only if they change"""
+        if len(state.match_group_start) > 0:
+            group_starts = list(group_starts)
+            for match_group in state.match_group_start:
+                group_starts[match_group] = position
+            group_starts = tuple(group_starts)
+        if len(state.match_group_end) > 0:
+            group_spans = list(group_spans)
+            for match_group in state.match_group_end:
+                start = group_starts[match_group]
+                if start < 0:
+                    start = start_position
+                group_spans[match_group] = (start, position + match_len)
+            group_spans = tuple(group_spans)
+        return group_starts, group_spans
 
     @staticmethod
-    def add_to_list(current_step, output_state, next_state_list):
+    def get_back_ref_text(arena, group_spans, match_group, text):
+        """Returns text of the match group in group_spans, None if it wasn't matched or is empty (a back reference to
+        it doesn't match)"""
+        if match_group >= len(group_spans) or group_spans[match_group] is None:
+            return None
+        start, end = group_spans[match_group]
+        if start == end:
+            return None
+        return text[start - arena.base:end - arena.base]
+
+    def add_to_list(self, arena, state, rep_counters, start_position):
         """
-        Helper function to avoid adding steps that contain states already on the list and with positions
-        greater or equal to checked step
+        Helper function to avoid adding steps equivalent to steps already created at the same position: steps in
+        the same state with the same repetition counters. The step already on the frontier was started earlier or at
+        the same position, so it takes precedence. With back references, only steps of the same thread are equivalent.
+        Threads losing steps to earlier threads are recorded in arena.overtaken, see lost_threads.
         """
-        for sss in next_state_list:
-            if output_state == sss.state and current_step.position + current_step.match_len >= sss.position:
-                return False
-        return True
-
-    @staticmethod
-    def find_match_text(match_group_name, match_end_step):
-        """Helper function to find match group text"""
-        match_text = match_end_step.matched_text()
-        step = match_end_step.prev_step
-        while step is not None:
-
-            match_text = step.matched_text() + match_text
-            if match_group_name in step.state.match_group_start:
-                return match_text
-            step = step.prev_step
-        return match_text
+        key = (rep_counters, start_position if self.has_back_references else None)
+        state_no = state.state_no
+        if arena.frontier_generation[state_no] != arena.generation:
+            arena.frontier_generation[state_no] = arena.generation
+            arena.frontier_keys[state_no] = {key: start_position}
+            return True
+        keys = arena.frontier_keys[state_no]
+        holder_start = keys.get(key)
+        if holder_start is None:
+            keys[key] = start_position
+            return True
+        if holder_start < start_position:
+            arena.overtaken[start_position] = min(holder_start, arena.overtaken.get(start_position, holder_start))
+        if self.stats is not None:
+            self.stats.dedup_rejections += 1
+        return False
 
     @staticmethod
-    def get_back_ref_text(ref_no, current_step):
-        """Helper function to find text of a match group references by ref_no"""
-        step = current_step
-        while step is not None:
-            if ref_no in step.state.match_group_end:
-                return step.back_ref_text
-            step = step.prev_step
-        return None
+    def find_lookahead(states):
+        """Returns number of characters states (except back references) look at from a position"""
+        lookahead = 2  # boundaries look at the character at the position and the next one
+        for state in states:
+            if state.state_type in State.literal_types:
+                lookahead = max(lookahead, len(state.match_values[0]))
+        return lookahead
@@ -0,0 +1,260 @@
+from array import array
+import mmap
+import sys
+
+from state_machine import NFA, State, MultiMatchState, NegativeMultiMatchState, MultiMatchUnicodeState, \
+    MatchAllState, RecurringState, ExpressionState, BackReferenceState, BoundaryState, EndState
+
+
+class NFAFormat:
+    """Flat binary format of a compiled NFA, so that patterns can be stored and loaded without parsing.
+
+    NFA is stored as integer arrays (array typecode "i"):
+    * header - magic, layout (byte order and size of the integers), then lengths of the sections and index of
+      the START node
+    * states - table of STATE_FIELDS integers per state, strings are indexes in the string table
+    * edges - indexes of output states, for each state: output, loop back output and loop output states
+    * groups - match group numbers, for each state: groups starting and ending at the state
+    * ranges - (first, last) code point pairs of the character classes and of the unicode properties (negation
+      included), so loading doesn't look the properties up
+    * string offsets - start of every string in the string blob, utf-8 encoded strings follow
+    Library is a file of many NFAs, keyed by their patterns, it starts with the layout as well. It's memory mapped on
+    load, the arrays are read in place if the layout is the one of the machine, else they're converted.
+    """
+
+    magic = b"RXN2"
+    library_magic = b"RXL2"
+    byte_orders = ["little", "big"]
+
+    # fields of a state in the state table
+    STATE_FIELDS = 17
+    KIND, STATE_TYPE, LABEL, VALUE, STATE_NO, NUMBER, MIN_REP, MAX_REP, EDGES, OUTPUTS, LOOP_BACK_OUTPUTS, \
+        LOOP_OUTPUTS, GROUPS, GROUP_STARTS, GROUP_ENDS, RANGES, RANGE_COUNT = range(STATE_FIELDS)
+
+    # kinds of states, i.e. classes
+    kinds = [State, MultiMatchState, NegativeMultiMatchState, MultiMatchUnicodeState, MatchAllState, RecurringState,
+             ExpressionState, BackReferenceState, BoundaryState, EndState]
+    boundary_chars = {boundary_type: char for char, boundary_type in BoundaryState.boundary_mapping.items()}
+
+    @staticmethod
+    def dumps(nfa):
+        """Returns bytes of the NFA given by its START node"""
+        states = NFA.reachable_states(nfa)
+        state_index = {id(state): index for index, state in enumerate(states)}
+        table = array("i")
+        edges = array("i")
+        groups = array("i")
+        ranges = array("i")
+        strings = {}
+
+        def string_index(string):
+            if string is None:
+                return -1
+            return strings.setdefault(string, len(strings))
+
+        for state in states:
+            kind = NFAFormat.kinds.index(type(state))
+            row = [0] * NFAFormat.STATE_FIELDS
+            row[NFAFormat.KIND] = kind
+            row[NFAFormat.STATE_TYPE] = string_index(state.state_type)
+            row[NFAFormat.LABEL] = string_index(state.state_label)
+            row[NFAFormat.VALUE] = -1
+            row[NFAFormat.STATE_NO] = state.state_no
+            state_ranges = None
+            if type(state) is State:
+                row[NFAFormat.VALUE] = string_index(state.match_values[0])
+            elif type(state) is MultiMatchUnicodeState:
+                row[NFAFormat.NUMBER] = int(state.is_negative)
+                state_ranges = state.matched_ranges()
+            elif type(state) is RecurringState:
+                row[NFAFormat.NUMBER] = state.rec_no
+                row[NFAFormat.MIN_REP] = state.min_rep
+                row[NFAFormat.MAX_REP] = state.max_rep
+            elif type(state) is BackReferenceState:
+                row[NFAFormat.NUMBER] = int(state.ref_no)
+            elif type(state) is BoundaryState:
+                row[NFAFormat.VALUE] = string_index(NFAFormat.boundary_chars[state.boundary_type])
+            elif type(state) is EndState:
+                row[NFAFormat.NUMBER] = state.pattern_no
+
+            output_lists = [state.output_states or [], state.loop_back_output_states,
+                            state.loop_output_states if type(state) is RecurringState else []]
+            row[NFAFormat.EDGES] = len(edges)
+            row[NFAFormat.OUTPUTS], row[NFAFormat.LOOP_BACK_OUTPUTS], row[NFAFormat.LOOP_OUTPUTS] = \
+                [len(output_list) for output_list in output_lists]
+            for output_list in output_lists:
+                edges.extend(state_index[id(output_state)] for output_state in output_list)
+
+            row[NFAFormat.GROUPS] = len(groups)
+            row[NFAFormat.GROUP_STARTS] = len(state.match_group_start)
+            row[NFAFormat.GROUP_ENDS] = len(state.match_group_end)
+            groups.extend(state.match_group_start + state.match_group_end)
+
+            if isinstance(state, MultiMatchState):
+                state_ranges = state.ranges
+            if state_ranges is not None:
+                row[NFAFormat.RANGES] = len(ranges) // 2
+                row[NFAFormat.RANGE_COUNT] = len(state_ranges)
+                for first, last in state_ranges:
+                    ranges.extend([first, last])
+            table.extend(row)
+
+        blob = bytearray()
+        string_offsets = array("i", [0])
+        for string in strings:
+            blob += string.encode("utf-8")
+            string_offsets.append(len(blob))
+
+        header = array("i", [len(table), len(edges), len(groups), len(ranges), len(string_offsets), len(blob), 0])
+        return NFAFormat.magic + NFAFormat.layout() + \
+            b"".join(section.tobytes() for section in [header, table, edges, groups, ranges, string_offsets]) + \
+            NFAFormat.pad(bytes(blob))
+
+    @staticmethod
+    def layout():
+        """Returns 4 bytes describing the integers written on this machine: byte order, size, 2 zero bytes"""
+        return bytes([NFAFormat.byte_orders.index(sys.byteorder), array("i").itemsize, 0, 0])
+
+    @staticmethod
+    def read_layout(layout):
+        """Returns (typecode, swap) to read integers written with the layout: array typecode of their size and
+        True if their byte order isn't the one of the machine"""
+        item_size = layout[1]
+        typecodes = [typecode for typecode in "hilq" if array(typecode).itemsize == item_size]
+        if layout[0] >= len(NFAFormat.byte_orders) or len(typecodes) == 0:
+            raise ValueError("unsupported integer layout of a compiled NFA")
+        return typecodes[0], NFAFormat.byte_orders[layout[0]] != sys.byteorder
+
+    @staticmethod
+    def read_ints(data, typecode, swap):
+        """Returns the integers in the memory view, in place if they don't have to be swapped"""
+        if not swap:
+            return data.cast(typecode)
+        ints = array(typecode, bytes(data))
+        ints.byteswap()
+        return ints
+
+    @staticmethod
+    def pad(data):
+        """Returns data padded with zeros to a multiple of integer size, so the next array is aligned"""
+        item_size = array("i").itemsize
+        return data + bytes(-len(data) % item_size)
+
+    @staticmethod
+    def loads(data):
+        """Returns START node of the NFA stored in data (bytes, mmap or memoryview)"""
+        data = memoryview(data)
+        if data[:4] != NFAFormat.magic:
+            raise ValueError("not a compiled NFA")
+        typecode, swap = NFAFormat.read_layout(data[4:8])
+        item_size = array(typecode).itemsize
+        offset = 8
+        header = NFAFormat.read_ints(data[offset:offset + 7 * item_size], typecode, swap)
+        offset += 7 * item_size
+        sections = []
+        for length in header[:5]:
+            sections.append(NFAFormat.read_ints(data[offset:offset + length * item_size], typecode, swap))
+            offset += length * item_size
+        table, edges, groups, ranges, string_offsets = sections
+        blob = bytes(data[offset:offset + header[5]])
+        strings = [blob[string_offsets[i]:string_offsets[i + 1]].decode("utf-8")
+                   for i in range(len(string_offsets) - 1)]
+
+        def string(index):
+            return None if index < 0 else strings[index]
+
+        def state_ranges(row):
+            first = 2 * row[NFAFormat.RANGES]
+            return [(ranges[i], ranges[i + 1]) for i in range(first, first + 2 * row[NFAFormat.RANGE_COUNT], 2)]
+
+        states = []
+        fields = NFAFormat.STATE_FIELDS
+        for row_start in range(0, len(table), fields):
+            row = table[row_start:row_start + fields]
+            kind = NFAFormat.kinds[row[NFAFormat.KIND]]
+            label = string(row[NFAFormat.LABEL])
+            if kind is State:
+                state = State(string(row[NFAFormat.STATE_TYPE]), label, [string(row[NFAFormat.VALUE])], [])
+            elif kind is MultiMatchState or kind is NegativeMultiMatchState:
+                state = kind(label, [], [])
+                state.state_label = label
+                state.set_ranges(state_ranges(row))
+            elif kind is MultiMatchUnicodeState:
+                state = MultiMatchUnicodeState(label, label, [], row[NFAFormat.NUMBER] == 1, state_ranges(row))
+            elif kind is MatchAllState:
+                state = MatchAllState(label, [])
+            elif kind is RecurringState:
+                state = RecurringState(label, [], row[NFAFormat.MIN_REP], row[NFAFormat.MAX_REP],
+                                       row[NFAFormat.NUMBER])
+            elif kind is ExpressionState:
+                state = ExpressionState(label, [])
+            elif kind is BackReferenceState:
+                state = BackReferenceState(label, str(row[NFAFormat.NUMBER]), [])
+            elif kind is BoundaryState:
+                state = BoundaryState(label, string(row[NFAFormat.VALUE]), [])
+            else:
+                state = EndState()
+                state.pattern_no = row[NFAFormat.NUMBER]
+            state.state_no = row[NFAFormat.STATE_NO]
+            states.append(state)
+
+        for index, state in enumerate(states):
+            row = table[index * fields:(index + 1) * fields]
+            edge = row[NFAFormat.EDGES]
+            output_lists = []
+            for count in [row[NFAFormat.OUTPUTS], row[NFAFormat.LOOP_BACK_OUTPUTS], row[NFAFormat.LOOP_OUTPUTS]]:
+                output_lists.append([states[i] for i in edges[edge:edge + count]])
+                edge += count
+            if state.output_states is not None:
+                state.output_states = output_lists[0]
+            state.loop_back_output_states = output_lists[1]
+            if type(state) is RecurringState:
+                state.loop_output_states = output_lists[2]
+
+            group = row[NFAFormat.GROUPS]
+            group_starts = row[NFAFormat.GROUP_STARTS]
+            state.match_group_start = list(groups[group:group + group_starts])
+            state.match_group_end = list(groups[group + group_starts:group + group_starts + row[NFAFormat.GROUP_ENDS]])
+
+        return states[header[6]]
+
+    @staticmethod
+    def save_library(path, nfas):
+        """Writes dict pattern -> START node of NFA to the file"""
+        with open(path, "wb") as file:
+            file.write(NFAFormat.library_magic + NFAFormat.layout() + array("i", [len(nfas)]).tobytes())
+            for pattern, nfa in nfas.items():
+                pattern_bytes = pattern.encode("utf-8")
+                data = NFAFormat.dumps(nfa)
+                file.write(array("i", [len(pattern_bytes), len(data)]).tobytes() + NFAFormat.pad(pattern_bytes) + data)
+
+    @staticmethod
+    def load_library(path):
+        """Returns dict pattern -> START node of NFA read from the file written by save_library"""
+        with open(path, "rb") as file:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                view = memoryview(data)
+                try:
+                    return NFAFormat.read_library(view)
+                finally:
+                    view.release()
+
+    @staticmethod
+    def read_library(view):
+        """Returns dict pattern -> START node of NFA read from the memory view of a library"""
+        if view[:4] != NFAFormat.library_magic:
+            raise ValueError("not a compiled pattern library")
+        typecode, swap = NFAFormat.read_layout(view[4:8])
+        item_size = array(typecode).itemsize
+        offset = 8
+        count = NFAFormat.read_ints(view[offset:offset + item_size], typecode, swap)[0]
+        offset += item_size
+        ret = {}
+        for _ in range(count):
+            pattern_length, data_length = NFAFormat.read_ints(view[offset:offset + 2 * item_size], typecode, swap)
+            offset += 2 * item_size
+            pattern = bytes(view[offset:offset + pattern_length]).decode("utf-8")
+            offset += pattern_length + (-pattern_length % item_size)
+            ret[pattern] = NFAFormat.loads(view[offset:offset + data_length])
+            offset += data_length
+        return ret
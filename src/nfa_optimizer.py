@@ -0,0 +1,140 @@
+import os
+
+from state_machine import NFA, State, ExpressionState
+
+
+class NFAOptimizer:
+    """Simplifies the NFA graph built by the parser, the matches (match groups included) stay the same:
+    * dead state pruning - edges to states END can't be reached from are removed
+    * alternation prefix factoring - literal alternatives sharing a prefix, e.g. foo|foobar|food, are replaced by
+      the prefix followed by an alternation of the rest, i.e. foo(|bar|d), repeated until the alternatives form a trie
+    * literal merging - literal state followed by a literal state with no other predecessor become one literal state
+    Alternatives are factored and literals merged only in patterns without match groups, loop back edges stay at
+    the states they were at.
+    """
+
+    def __init__(self, nfa, start):
+        self.nfa = nfa  # NFA of the parser, its node_list is updated
+        self.start = start
+        self.new_states = []
+
+    @staticmethod
+    def optimize(nfa, start):
+        """Optimizes the NFA given by the parser's NFA and the START node, returns (states before, states after)"""
+        optimizer = NFAOptimizer(nfa, start)
+        before = len(NFA.reachable_states(start))
+        optimizer.prune_dead_states()
+        # with match groups, the order steps reach a state in decides which of ambiguous submatches is reported,
+        # factoring and merging change the order
+        if not any(len(state.match_group_start) > 0 for state in NFA.reachable_states(start)):
+            while optimizer.factor_prefixes() or optimizer.merge_literals():
+                pass
+        states = NFA.reachable_states(start)
+        reachable = {id(state) for state in states}
+        nfa.node_list = [state for state in nfa.node_list + optimizer.new_states if id(state) in reachable]
+        return before, len(states)
+
+    def predecessors(self):
+        """Returns dict id of state -> list of states with an edge to it, one entry per edge"""
+        states = NFA.reachable_states(self.start)
+        ret = {id(state): [] for state in states}
+        for state in states:
+            for edge_list in NFA.edge_lists(state):
+                for output_state in edge_list:
+                    ret[id(output_state)].append(state)
+        return ret
+
+    def is_literal(self, state):
+        """Returns True if the state is a literal, which can be merged into another state (not the START node)"""
+        return state.state_type in State.literal_types and state is not self.start
+
+    def prune_dead_states(self):
+        """Removes edges to states, which can't reach END"""
+        predecessors = self.predecessors()
+        states = NFA.reachable_states(self.start)
+        live = [state for state in states if state.state_type == "end"]
+        live_ids = {id(state) for state in live}
+        for state in live:
+            for predecessor in predecessors[id(state)]:
+                if id(predecessor) not in live_ids:
+                    live_ids.add(id(predecessor))
+                    live.append(predecessor)
+        if id(self.start) not in live_ids:
+            return  # nothing matches, the graph is left as it is
+        for state in states:
+            for edge_list in NFA.edge_lists(state):
+                edge_list[:] = [output_state for output_state in edge_list if id(output_state) in live_ids]
+
+    def factor_prefixes(self):
+        """Factors common prefixes of literal alternatives of every alternation, returns True if the graph changed"""
+        predecessors = self.predecessors()
+        changed = False
+        for state in NFA.reachable_states(self.start):
+            if state.state_type != "expression":
+                continue
+            # alternatives only this alternation leads to
+            alternatives = [output_state for output_state in state.output_states
+                            if self.is_literal(output_state) and len(predecessors[id(output_state)]) == 1]
+            by_first_char = {}
+            for alternative in alternatives:
+                by_first_char.setdefault(alternative.match_values[0][0], []).append(alternative)
+            for group in by_first_char.values():
+                prefix = os.path.commonprefix([alternative.match_values[0] for alternative in group])
+                # an alternative equal to the prefix is replaced by its output states, loop back edges can't move,
+                # the other alternatives keep them
+                group = [alternative for alternative in group
+                         if len(alternative.match_values[0]) > len(prefix)
+                         or len(alternative.loop_back_output_states) == 0]
+                if len(group) < 2:
+                    continue
+
+                rest = ExpressionState("EXP", [])
+                for alternative in group:
+                    if len(alternative.match_values[0]) > len(prefix):
+                        alternative.match_values = [alternative.match_values[0][len(prefix):]]
+                        alternative.state_type = "str match"
+                        alternative.state_label = alternative.match_values[0]
+                        rest.output_states.append(alternative)
+                    else:
+                        rest.output_states += [output_state for output_state in alternative.output_states
+                                               if output_state not in rest.output_states]
+                prefix_state = State("str match", prefix, [prefix], [rest])
+                self.new_states += [prefix_state, rest]
+                state.output_states[state.output_states.index(group[0])] = prefix_state
+                state.output_states[:] = [output_state for output_state in state.output_states
+                                          if output_state not in group[1:]]
+                changed = True
+        return changed
+
+    def merge_literals(self):
+        """Merges literal states followed by a literal state with no other predecessor, returns True if the graph
+        changed"""
+        predecessors = self.predecessors()
+        merged = set()  # ids of states merged into their predecessors
+        changed = False
+        for state in NFA.reachable_states(self.start):
+            if id(state) in merged:
+                continue
+            while self.can_merge(state, predecessors):
+                next_state = state.output_states[0]
+                self.merge(state, next_state)
+                merged.add(id(next_state))
+                changed = True
+        return changed
+
+    def can_merge(self, state, predecessors):
+        """Returns True if the state can be merged with its only output state"""
+        if state.state_type not in State.literal_types or len(state.output_states) != 1 or \
+                len(state.loop_back_output_states) > 0:
+            return False
+        next_state = state.output_states[0]
+        return self.is_literal(next_state) and next_state is not state and len(predecessors[id(next_state)]) == 1
+
+    @staticmethod
+    def merge(state, next_state):
+        """Appends the literal of the next state to the state, the state takes over the next state's edges"""
+        state.match_values = [state.match_values[0] + next_state.match_values[0]]
+        state.state_type = "str match"
+        state.state_label = state.match_values[0]
+        state.output_states = next_state.output_states
+        state.loop_back_output_states = next_state.loop_back_output_states
@@ -0,0 +1,193 @@
+from state_machine import NFA, State, NegativeMultiMatchState
+
+
+class Prefilter:
+    """Finds positions in text where a match of the NFA can start, so the engines don't try the other positions.
+
+    Facts extracted from the NFA graph:
+    * first_chars - characters every match starts with, None if it can start with (almost) any character
+    * prefix - literal every match starts with
+    * required_literal - the longest literal every match contains, i.e. a literal state on every path to END
+    * start_anchor - "start text" if every match starts at \\A, i.e. only at position 0, "start text or line" if
+      every match starts at \\A or ^, i.e. at line starts
+    Repetition counters are ignored, the graph allows more paths than the counters do, so the facts are conservative.
+    """
+
+    epsilon_types = ["repetition", "expression", "anchor"]
+    max_first_chars = 64
+    max_find_chars = 4  # larger sets of first characters are scanned for in one pass, see next_start
+
+    def __init__(self, nfa):
+        self.first_chars = None
+        self.prefix = None
+        self.required_literal = None
+        self.start_anchor = self.find_start_anchor(nfa)
+
+        first_states = self.first_states(nfa)
+        if len(first_states) == 1 and first_states[0].state_type in State.literal_types:
+            self.prefix = first_states[0].match_values[0]
+        self.first_chars = self.find_first_chars(first_states)
+
+        literals = [state.match_values[0] for state in self.required_states(nfa)
+                    if state.state_type in State.literal_types]
+        if len(literals) > 0:
+            self.required_literal = max(literals, key=len)
+            if self.prefix is not None and self.prefix.find(self.required_literal) >= 0:
+                self.required_literal = None
+
+    def is_empty(self):
+        """Returns True if no position can be skipped"""
+        return self.first_chars is None and self.prefix is None and self.required_literal is None and \
+            self.start_anchor is None
+
+    def next_candidate(self, text, position, next_positions, text_end=True):
+        """Returns the first position at or after the position a match can start at, -1 if there's none.
+        next_positions is the cache of found occurrences, it has to be kept for the whole scan of the text.
+        If text_end isn't set, more text follows, the required literal can be found in it"""
+        if self.start_anchor == "start text" and position > 0:
+            return -1
+        if text_end and self.required_literal is not None and \
+                self.find(text, self.required_literal, position, next_positions) < 0:
+            return -1
+        if self.start_anchor != "start text or line":
+            return self.next_start(text, position, next_positions)
+
+        # the position has to be a line start where the first character can match
+        while True:
+            position = self.next_line_start(text, position, next_positions)
+            if position < 0:
+                return -1
+            candidate = self.next_start(text, position, next_positions)
+            if candidate < 0 or candidate == position:
+                return candidate
+            position = candidate
+
+    def can_start_at(self, text, position):
+        """Returns False if the start anchor doesn't allow a match to start at the position"""
+        if self.start_anchor == "start text":
+            return position == 0
+        if self.start_anchor == "start text or line":
+            return position == 0 or text[position - 1] in "\n\r"
+        return True
+
+    def next_line_start(self, text, position, next_positions):
+        """Returns the first line start at or after the position, -1 if there's none"""
+        if self.can_start_at(text, position):
+            return position
+        found = [self.find(text, char, position, next_positions) for char in "\n\r"]
+        return min([p + 1 for p in found if p >= 0], default=-1)
+
+    def next_start(self, text, position, next_positions):
+        """Returns the first position at or after the position, where the prefix or one of the first characters is.
+        Few first characters are searched for one by one (str.find), more are tested character by character, a find
+        per character would rescan the text for each of them"""
+        if self.prefix is not None:
+            return self.find(text, self.prefix, position, next_positions)
+        if self.first_chars is None:
+            return position
+        if len(self.first_chars) <= self.max_find_chars:
+            found = [self.find(text, char, position, next_positions) for char in self.first_chars]
+            return min([p for p in found if p >= 0], default=-1)
+        first_chars = self.first_chars
+        for index in range(position, len(text)):
+            if text[index] in first_chars:
+                return index
+        return -1
+
+    @staticmethod
+    def find(text, literal, position, next_positions):
+        """Returns position of the next occurrence of the literal at or after the position, -1 if there's none"""
+        found = next_positions.get(literal)
+        if found is None or 0 <= found < position:
+            found = text.find(literal, position)
+            next_positions[literal] = found
+        return found
+
+    @staticmethod
+    def first_states(nfa):
+        """Returns list of states, which can match the first character of a match"""
+        ret = []
+        visited = {id(nfa)}
+        states = [nfa]
+        for state in states:
+            if state.state_type == "end":
+                continue
+            if state.state_type not in Prefilter.epsilon_types:
+                ret.append(state)
+                continue
+            for output_state in NFA.output_states(state):
+                if id(output_state) not in visited:
+                    visited.add(id(output_state))
+                    states.append(output_state)
+        return ret
+
+    @staticmethod
+    def find_start_anchor(nfa):
+        """Returns boundary type of the start anchor every path from the START node passes before it matches
+        a character, None if some path doesn't pass one"""
+        anchors = set()
+        visited = {id(nfa)}
+        states = [nfa]
+        for state in states:
+            if state.state_type == "anchor" and state.boundary_type in ["start text", "start text or line"]:
+                anchors.add(state.boundary_type)
+                continue
+            if state.state_type not in Prefilter.epsilon_types:
+                return None
+            for output_state in NFA.output_states(state):
+                if id(output_state) not in visited:
+                    visited.add(id(output_state))
+                    states.append(output_state)
+        if len(anchors) == 0:
+            return None
+        # ^ matches at the start of text as well
+        return "start text" if anchors == {"start text"} else "start text or line"
+
+    @staticmethod
+    def find_first_chars(first_states):
+        """Returns set of characters the first states can match, None if it's too large or not known"""
+        first_chars = set()
+        for state in first_states:
+            if state.state_type in State.literal_types:
+                first_chars.add(state.match_values[0][0])
+            elif state.state_type == "multi match" and not isinstance(state, NegativeMultiMatchState):
+                for first, last in state.ranges:
+                    if len(first_chars) + last - first + 1 > Prefilter.max_first_chars:
+                        return None
+                    first_chars.update(chr(code_point) for code_point in range(first, last + 1))
+            else:
+                return None
+            if len(first_chars) > Prefilter.max_first_chars:
+                return None
+        return first_chars
+
+    @staticmethod
+    def required_states(nfa):
+        """Returns list of states on every path from the START node to END (dominators of END)"""
+        states = NFA.reachable_states(nfa)
+        predecessors = {id(state): [] for state in states}
+        for state in states:
+            for output_state in NFA.output_states(state):
+                predecessors[id(output_state)].append(state)
+
+        # iterative data flow: a state is dominated by itself and by states dominating all of its predecessors
+        all_states = frozenset(id(state) for state in states)
+        dominators = {id(state): all_states for state in states}
+        dominators[id(nfa)] = frozenset([id(nfa)])
+        changed = True
+        while changed:
+            changed = False
+            for state in states[1:]:
+                new_dominators = all_states
+                for predecessor in predecessors[id(state)]:
+                    new_dominators = new_dominators & dominators[id(predecessor)]
+                new_dominators = new_dominators | {id(state)}
+                if new_dominators != dominators[id(state)]:
+                    dominators[id(state)] = new_dominators
+                    changed = True
+
+        end_states = [state for state in states if state.state_type == "end"]
+        if len(end_states) == 0:
+            return []
+        required = frozenset.intersection(*[dominators[id(state)] for state in end_states])
+        return [state for state in states if id(state) in required]
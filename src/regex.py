@@ -1,28 +1,271 @@
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
 from regex_parser import RegExParser
 from interpreter import Interpreter
+from dfa import LazyDFA
+from interpreter import MatchResult
+from state_machine import NFA, State
+from nfa_format import NFAFormat
+from codegen import CompiledDFA
+from bit_parallel import BitParallel
+from dense_dfa import DenseDFA
+
+# compiled patterns: pattern -> (RegExParser, engine), the least recently used pattern is evicted first
+# patterns loaded from a library (see load_library) have no parser
+cache = OrderedDict()
+compiled_cache = {}  # pattern -> CompiledDFA or None if the pattern can't be compiled, see RegEx codegen
+dense_cache = {}  # pattern -> DenseDFA or None if the pattern can't be compiled, see RegEx.match_batch
+cache_size = 512
+cache_hits = 0
+cache_misses = 0
+
+worker_engine = None  # engine of the pattern matched by a worker process, see init_worker
+
+
+def purge():
+    """Clears the compiled patterns cache"""
+    global cache_hits, cache_misses
+    cache.clear()
+    compiled_cache.clear()
+    dense_cache.clear()
+    cache_hits = 0
+    cache_misses = 0
+
+
+def compile_pattern(pattern):
+    """Returns (RegExParser, engine) of the pattern, taken from the cache if the pattern was compiled before.
+    Engine is None if the pattern couldn't be parsed, such patterns aren't cached"""
+    global cache_hits, cache_misses
+    compiled = cache.get(pattern)
+    if compiled is not None:
+        cache_hits += 1
+        cache.move_to_end(pattern)
+        return compiled
+
+    cache_misses += 1
+    regex_parser = RegExParser(pattern)
+    result, nfa = regex_parser.parse()
+    if not result:
+        return regex_parser, None
+    return add_to_cache(pattern, regex_parser, nfa)
+
+
+def add_to_cache(pattern, regex_parser, nfa):
+    """Creates engine of the NFA and caches it, returns (RegExParser, engine)"""
+    if LazyDFA.supports(nfa):
+        engine = BitParallel.compile(nfa) or LazyDFA(nfa)
+    else:
+        engine = Interpreter(nfa)
+
+    cache[pattern] = (regex_parser, engine)
+    if len(cache) > cache_size:
+        cache.popitem(last=False)
+    return regex_parser, engine
+
+
+def compile_to_code(pattern, engine):
+    """Returns CompiledDFA of the pattern compiled to the engine, generated once per pattern. Returns the engine if
+    the pattern can't be compiled to code"""
+    if pattern not in compiled_cache:
+        compiled_cache[pattern] = CompiledDFA.compile(engine.nfa, pattern) if isinstance(engine, LazyDFA) else None
+        if len(compiled_cache) > cache_size:
+            del compiled_cache[next(iter(compiled_cache))]
+    return compiled_cache[pattern] or engine
+
+
+def get_dense_dfa(pattern, engine):
+    """Returns DenseDFA of the pattern compiled to the engine, built once per pattern. Returns None if numpy isn't
+    available or the pattern can't be compiled"""
+    if pattern not in dense_cache:
+        dense_cache[pattern] = DenseDFA.compile(engine.nfa, pattern)
+        if len(dense_cache) > cache_size:
+            del dense_cache[next(iter(dense_cache))]
+    return dense_cache[pattern]
+
+
+def save_library(path, patterns):
+    """Compiles the patterns and writes their NFAs to the file, patterns which can't be parsed are skipped"""
+    nfas = {}
+    for pattern in patterns:
+        _, engine = compile_pattern(pattern)
+        if engine is not None:
+            nfas[pattern] = engine.nfa
+    NFAFormat.save_library(path, nfas)
+
+
+def load_library(path):
+    """Loads patterns compiled by save_library into the cache, RegEx objects of the patterns are created without
+    parsing"""
+    for pattern, nfa in NFAFormat.load_library(path).items():
+        add_to_cache(pattern, None, nfa)
+
+
+def load_regex(pattern, data, codegen=False, keep_steps=False):
+    """Returns RegEx of the pattern with NFA loaded from data, used by pickle"""
+    if pattern not in cache:
+        add_to_cache(pattern, None, NFAFormat.loads(data))
+    return RegEx(pattern, codegen, keep_steps)
+
+
+def read_chunks(fileobj, chunk_size):
+    """Generate chunks of text read from the file object"""
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+def init_worker(regex):
+    """Sets the engine matched by the worker process, the RegEx is passed pickled as its compiled NFA (see
+    RegEx.__reduce__), so workers don't parse the pattern"""
+    global worker_engine
+    worker_engine = regex.engine
+
+
+def match_in_worker(text):
+    """Matches the text in a worker process, returns list of (position, end, group spans) of the matches"""
+    return [(m.position, m.end, m.group_spans) for m in worker_engine.finditer(text)]
+
+
+def split_lines(text, parts):
+    """Returns list of (offset, part) of the text split after new lines into about the number of parts"""
+    part_size = max(1, len(text) // parts)
+    ret = []
+    start = 0
+    while start < len(text):
+        end = text.find("\n", start + part_size)
+        end = len(text) if end < 0 else end + 1
+        ret.append((start, text[start:end]))
+        start = end
+    return ret
 
 
 class RegEx:
-    """Facade of the RegEx Machine"""
+    """Facade of the RegEx Machine.
+    Patterns without back references and anchors are matched with the BitParallel engine if they have few enough
+    positions, else with the LazyDFA, the others with the Interpreter.
+    Compiled patterns are cached, RegEx objects of the same pattern share the parser and the engine.
+    With codegen, patterns the LazyDFA matches are compiled to a generated Python function (see CompiledDFA), the
+    others use their engine as usual.
+    With keep_steps, the pattern is matched by an Interpreter of its own, which keeps the steps of the threads, match
+    results get step_list, the list of steps leading to the match. Without it, step_list is empty.
+    Texts can be matched in parallel by a pool of processes, every worker process loads the compiled NFA once"""
 
     verbose = 0
 
-    def __init__(self, pattern):
-        self.regex_parser = RegExParser(pattern)
-        result, nfa = self.regex_parser.parse()
-        if result:
-            self.interpreter = Interpreter(nfa)
-        else:
-            self.interpreter = None
+    def __init__(self, pattern, codegen=False, keep_steps=False):
+        self.pattern = pattern
+        self.codegen = codegen
+        self.keep_steps = keep_steps
+        self.regex_parser, self.engine = compile_pattern(pattern)
+        if keep_steps and self.engine is not None:
+            # the cached engine is shared by RegEx objects of the pattern, steps are kept by a separate Interpreter
+            self.engine = Interpreter(self.engine.nfa)
+            self.engine.keep_steps = True
+        elif codegen and self.engine is not None:
+            self.engine = compile_to_code(pattern, self.engine)
+
+    def match_all(self, text, workers=None):
+        """Returns list of all matches in the text. If workers is given and no match can span lines, the text is split
+        into lines matched in parallel by the number of worker processes"""
+        if workers is None or workers < 2 or not self.can_split_lines():
+            return self.engine.match_all(text)
+
+        parts = split_lines(text, workers * 4)
+        ret = []
+        with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(self,)) as executor:
+            for (offset, _), matches in zip(parts, executor.map(match_in_worker, [part for _, part in parts])):
+                ret += [self.to_match_result(text, match, offset) for match in matches]
+        return ret
 
-    def match_all(self, text):
-        return self.interpreter.match_all(text)
+    def match_many(self, texts, workers=None):
+        """Returns list of match_all results of the texts, in order of the texts, matched by the number of worker
+        processes (by default the number of processors)"""
+        texts = list(texts)
+        chunk_size = max(1, len(texts) // ((workers or 1) * 16))
+        with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(self,)) as executor:
+            return [[self.to_match_result(text, match, 0) for match in matches]
+                    for text, matches in zip(texts, executor.map(match_in_worker, texts, chunksize=chunk_size))]
+
+    def to_match_result(self, text, match, offset):
+        """Returns MatchResult of a match found by a worker in the part of the text starting at the offset"""
+        position, end, group_spans = match
+        if group_spans is not None:
+            group_spans = tuple(None if span is None else (span[0] + offset, span[1] + offset) for span in group_spans)
+        return MatchResult(text, position + offset, end + offset, group_spans, engine=self.engine)
+
+    def can_split_lines(self):
+        """Returns True if text split into lines has the same matches as the whole text, i.e. no state can match
+        new line and there's no start or end text anchor"""
+        for state in NFA.reachable_states(self.engine.nfa):
+            if state.state_type in State.literal_types:
+                if state.match_values[0].find("\n") >= 0:
+                    return False
+            elif state.state_type == "anchor":
+                if state.boundary_type in ["start text", "end text"]:
+                    return False
+            elif state.state_type not in ["repetition", "expression", "back reference", "end"]:
+                if state.is_matched("\n", 0)[0]:
+                    return False
+        return True
 
     def match_first(self, text):
-        return self.interpreter.match_first(text)
+        return self.engine.match_first(text)
 
-    def print_graph(self):
-        print(self.regex_parser.tokenizer.regex_pattern)
-        self.regex_parser.nfa.print_graph()
+    def match_batch(self, texts):
+        """Returns list of the longest matches at the start of the texts, None for texts which don't match there.
+        With numpy, patterns the DFA supports are matched by the DenseDFA, all texts in lockstep, the others are
+        matched one by one"""
+        texts = list(texts)
+        dense = get_dense_dfa(self.pattern, self.engine)
+        if dense is not None:
+            return dense.match_batch(texts)
+        return [self.engine.match(text, 0) for text in texts]
+
+    def finditer(self, text, pos=0, endpos=None):
+        """Generate matches in the text between pos and endpos one by one, the scan stops when the caller does"""
+        return self.engine.finditer(text, pos, endpos)
 
+    def finditer_stream(self, fileobj, chunk_size=65536):
+        """Generate matches in text read from a file object in chunks of chunk_size characters, the match positions
+        are offsets in the whole text. Only the part of text alive threads may need is kept in memory.
+        Text is matched with the Interpreter, DFA matching isn't resumable"""
+        engine = self.engine
+        if isinstance(engine, LazyDFA):
+            engine = engine.get_interpreter()
+        return engine.match_stream(read_chunks(fileobj, chunk_size))
 
+    def enable_stats(self, enabled=True):
+        """Starts or stops collecting statistics of the Interpreter matching the pattern, the engine is shared by
+        RegEx objects of the same pattern, so are the statistics"""
+        if isinstance(self.engine, Interpreter):
+            self.engine.enable_stats(enabled)
+
+    def stats(self):
+        """Returns dict of matching statistics: engine name, number of positions of the BitParallel engine, number of
+        DFA states built by the LazyDFA, counters of the Interpreter (see InterpreterStats) if collecting them was
+        enabled"""
+        if isinstance(self.engine, BitParallel):
+            return {"engine": "bit-parallel", "positions": len(self.engine.positions)}
+        if isinstance(self.engine, LazyDFA):
+            engine = "codegen" if isinstance(self.engine, CompiledDFA) else "dfa"
+            return {"engine": engine, "dfa_states": len(self.engine.states), "cache_entries": self.engine.cache_entries}
+        ret = {"engine": "interpreter"}
+        if self.engine.stats is not None:
+            ret.update(self.engine.stats.to_dict())
+        return ret
+
+    def __reduce__(self):
+        """RegEx is pickled as its compiled NFA, so unpickling doesn't parse the pattern"""
+        return load_regex, (self.pattern, NFAFormat.dumps(self.engine.nfa), self.codegen, self.keep_steps)
+
+    def print_graph(self):
+        print(self.pattern)
+        if self.regex_parser is None:
+            for state in NFA.reachable_states(self.engine.nfa):
+                print(state.to_string())
+                print(state.output_states_to_string())
+            return
+        self.regex_parser.nfa.print_graph()
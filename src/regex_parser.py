@@ -1,6 +1,7 @@
 from state_machine import State, MatchAllState, MultiMatchState, RecurringState, EndState, ExpressionState, NFA, \
     NegativeMultiMatchState, BackReferenceState, BoundaryState, MultiMatchUnicodeState
 from tokenizer import Tokenizer
+from nfa_optimizer import NFAOptimizer
 import codecs
 
 
@@ -26,6 +27,7 @@ class RegExParser:
         self.group_list = []
         self.rec_list = []
         self.nfa = NFA()
+        self.optimize = True  # simplify the graph, see NFAOptimizer
 
     def next_token(self):
         """
@@ -251,7 +253,7 @@ class RegExParser:
         elif self.current_token[0] == "escaped setelement":
             multi_match_state.add_multi(match)
         else:
-            multi_match_state.match_values.append(match)
+            multi_match_state.add_char(match)
         self.nfa.add_node(multi_match_state)
         self.next_token()
 
@@ -268,7 +270,7 @@ class RegExParser:
                 multi_match_state.add_multi(self.current_token[1])
                 multi_match_state.state_label += self.current_token[1]
             else:
-                multi_match_state.match_values.append(self.current_token[1])
+                multi_match_state.add_char(self.current_token[1])
                 multi_match_state.state_label += self.current_token[1]
 
             self.next_token()
@@ -383,7 +385,8 @@ class RegExParser:
                 rep_label += self.current_token[1]
 
             recurring_state = RecurringState(rep_label + ": " + str(len(self.rec_list)) + " min=" + str(min_rep)
-                                             + " max=" + str(max_rep), [atom_state], min_rep, max_rep)
+                                             + " max=" + str(max_rep), [atom_state], min_rep, max_rep,
+                                             len(self.rec_list))
             self.nfa.add_node(recurring_state)
             self.rec_list += [recurring_state]
 
@@ -483,5 +486,9 @@ class RegExParser:
         result, expression, output_state = self.expression()
         if not result:
             return False, None
+        if self.optimize:
+            before, after = NFAOptimizer.optimize(self.nfa, expression)
+            self.print_log("optimized NFA: " + str(before) + " -> " + str(after) + " states")
+        NFA.number_states(expression)
         return self.current_token == ("end", None), expression
 
@@ -0,0 +1,84 @@
+from regex_parser import RegExParser
+from state_machine import NFA, ExpressionState
+from interpreter import Interpreter
+from dfa import LazyDFA
+
+
+class RegexSet:
+    """Set of patterns matched together in a single pass over text.
+
+    Patterns are parsed separately and merged under one ExpressionState root, END state of every pattern is tagged
+    with pattern_no, the index of the pattern in the list. States and repetition counters are renumbered, so that
+    every state of the set has its own state_no and every RecurringState its own counter.
+    * matches(text) returns numbers of all patterns matching the text, the patterns are matched with the combined
+      DFA in search mode, patterns the DFA doesn't support (see LazyDFA.supports) are matched one by one
+    * finditer(text) generates non overlapping, leftmost-longest matches of any of the patterns, pattern_no of
+      a match result is the lowest number of the patterns matching the longest text, groups of the match result are
+      the match groups of that pattern
+    Patterns, which couldn't be parsed, are listed in invalid_patterns and never match.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.invalid_patterns = []
+        self.group_counts = [0] * len(self.patterns)  # number of match groups of every pattern
+        roots = []
+        rec_count = 0
+        state_count = 0
+        for pattern_no, pattern in enumerate(self.patterns):
+            regex_parser = RegExParser(pattern)
+            result, root = regex_parser.parse()
+            if not result:
+                self.invalid_patterns.append(pattern_no)
+                continue
+            self.group_counts[pattern_no] = regex_parser.nfa.max_match_group_no
+            states = NFA.reachable_states(root)
+            for state in states:
+                state.state_no += state_count
+                if state.state_type == "repetition":
+                    state.rec_no += rec_count
+                elif state.state_type == "end":
+                    state.pattern_no = pattern_no
+            state_count += len(states)
+            rec_count += len(regex_parser.rec_list)
+            roots.append((pattern_no, root))
+
+        self.nfa = ExpressionState("pattern set", [root for _, root in roots])
+        self.nfa.state_no = state_count
+        self.search_dfa = None  # finds patterns the DFA supports
+        self.other_engines = []  # (pattern_no, engine) of patterns the DFA doesn't support
+        dfa_roots = []
+        for pattern_no, root in roots:
+            if LazyDFA.supports(root):
+                dfa_roots.append(root)
+            else:
+                self.other_engines.append((pattern_no, Interpreter(root)))
+        if len(dfa_roots) > 0:
+            search_root = ExpressionState("pattern set", dfa_roots)
+            search_root.state_no = state_count + 1
+            self.search_dfa = LazyDFA(search_root, search=True)
+
+        if len(self.other_engines) == 0:
+            self.engine = LazyDFA(self.nfa)
+        else:
+            self.engine = Interpreter(self.nfa)
+
+    def matches(self, text):
+        """Returns sorted list of numbers of the patterns matching the text"""
+        found = set()
+        if self.search_dfa is not None:
+            found = self.search_dfa.matching_patterns(text)
+        for pattern_no, engine in self.other_engines:
+            if any(True for _ in engine.finditer(text)):
+                found.add(pattern_no)
+        return sorted(found)
+
+    def finditer(self, text, pos=0, endpos=None):
+        """Generate matches of the patterns in the text between pos and endpos, pattern_no of the match result is
+        number of the matched pattern"""
+        for match_result in self.engine.finditer(text, pos, endpos):
+            match_result.group_count = self.group_counts[match_result.pattern_no]
+            yield match_result
+
+    def match_all(self, text):
+        return list(self.finditer(text))
@@ -1,7 +1,7 @@
-import unicodedata
+from array import array
+from bisect import bisect_right
 
 import unicode
-import unicodedata2
 
 
 class NFA:
@@ -18,6 +18,42 @@ class NFA:
     def add_node(self, node):
         self.node_list.append(node)
 
+    @staticmethod
+    def reachable_states(start_state):
+        """Returns list of all states reachable from start_state (inclusive), in the order of discovery"""
+        visited = {id(start_state)}
+        ret = [start_state]
+        for state in ret:
+            for output_state in NFA.output_states(state):
+                if id(output_state) not in visited:
+                    visited.add(id(output_state))
+                    ret.append(output_state)
+        return ret
+
+    @staticmethod
+    def edge_lists(state):
+        """Returns the lists of states the state has edges to: output states, loop back output states and loop output
+        states of repetitions. The lists themselves are returned, they can be changed in place"""
+        ret = [state.loop_back_output_states]
+        if state.output_states is not None:
+            ret.insert(0, state.output_states)
+        if state.state_type == "repetition":
+            ret.append(state.loop_output_states)
+        return ret
+
+    @staticmethod
+    def output_states(state):
+        """Returns list of all states the state has edges to"""
+        return [output_state for edge_list in NFA.edge_lists(state) for output_state in edge_list]
+
+    @staticmethod
+    def number_states(start_state):
+        """Numbers states reachable from start_state with consecutive state_no values, returns number of states"""
+        states = NFA.reachable_states(start_state)
+        for state_no, state in enumerate(states):
+            state.state_no = state_no
+        return len(states)
+
     def node_labels(self):
         return [n.state_label for n in self.node_list]
 
@@ -46,6 +82,8 @@ class NFA:
 class State:
     """Generic state node of NFA, used for string matching and as a base for other specialized states"""
 
+    literal_types = ["str match", "esc match", "char match"]  # state types matching the literal match_values[0]
+
     def __init__(self, state_type, state_label, match_values, output_states):
 
         # state_type:
@@ -68,7 +106,7 @@ class State:
         # match_values is a list
         # examples:
         # for state_type: string match: ["Marcin] or ["Tree"]
-        # for state_type: multi match: [" ", "\n", "\t", "\v"], ["a", "b", "c", ..., "z"]
+        # for state_type: multi match: None, characters are kept in MultiMatchState.ranges
         self.match_values = match_values
 
         # output states list, contains State objects
@@ -90,6 +128,8 @@ class State:
         self.match_group_start = []  # values: list of match group names that start here, e.g ["match_1", "match_2"]
         self.match_group_end = []  # values: list or match groups names that end here, e.g. ["match_1", "match_4"]
 
+        self.state_no = 0  # index of the state in its NFA, see NFA.number_states, unique in a pattern set
+
     def to_string(self):
         """Returns a string containing important information about the state"""
         ret = self.state_type + ": " + self.state_label
@@ -129,10 +169,11 @@ class State:
 
 
 class EndState(State):
-    """End state indicates end of state machine, one per NFA"""
+    """End state indicates end of state machine, one per NFA (one per pattern in NFA of a pattern set)"""
 
     def __init__(self):
         super().__init__("end", "end", None, None)
+        self.pattern_no = 0  # number of the pattern ending here, in NFA of a pattern set
 
     def is_matched(self, text, position):
         return True, 0
@@ -148,42 +189,92 @@ class MultiMatchState(State):
     *    \\s (match whitespace)
     *    \\w (match word characters)
     *    \\d (match digit)
+
+    Characters are kept as sorted, non overlapping ranges of code points (range_starts, range_ends), looked up with
+    bisect. Decisions for characters below 128 are precomputed in ascii_map, a 128 entry bitmap, decisions for the
+    other characters are memoized in memo (at most memo_size code points), text reuses a small alphabet.
     """
 
+    memo_size = 4096
+    is_negative = False
+
     def __init__(self, state_label, match_values, output_states):
-        super().__init__("multi match", state_label, match_values, output_states)
+        super().__init__("multi match", state_label, None, output_states)
+        self.ranges = []  # list of tuples (first code point, last code point), inclusive, sorted and merged
+        self.memo = {}  # code point -> decision, for code points above ASCII
+        self.set_ranges([])  # lookup tables of the empty class, negated if the class is negative
+        for char in match_values:
+            self.add_char(char)
+
+    def add_char(self, char):
+        self.add_code_points(ord(char), ord(char))
+
+    def add_code_points(self, first, last):
+        """Adds inclusive range of code points and recompiles the lookup tables"""
+        if first > last:
+            return
+
+        ranges = []
+        for range_first, range_last in sorted(self.ranges + [(first, last)]):
+            if len(ranges) > 0 and range_first <= ranges[-1][1] + 1:
+                ranges[-1] = (ranges[-1][0], max(ranges[-1][1], range_last))
+            else:
+                ranges.append((range_first, range_last))
+        self.set_ranges(ranges)
+
+    def set_ranges(self, ranges):
+        """Sets the ranges, which have to be sorted and merged already, and compiles the lookup tables"""
+        self.ranges = ranges
+        self.range_starts = array("L", [range_first for range_first, _ in ranges])
+        self.range_ends = array("L", [range_last for _, range_last in ranges])
+        self.ascii_map = bytes(self.contains(code_point) != self.is_negative for code_point in range(128))
+        self.memo = {}
 
     # range is: [a-z]
     def add_range(self, range_str):
         if len(range_str) < 3 or range_str[1] != "-":
             return False
 
-        self.match_values += [chr(x) for x in range(ord(range_str[0]), ord(range_str[2]) + 1)]
+        self.add_code_points(ord(range_str[0]), ord(range_str[2]))
         return True
 
     # digit, word (digit, letter, underscore), white space is: \d \w \s
     def add_multi(self, multi_str):
         if multi_str in "d":
-            self.match_values += [chr(x) for x in range(ord("0"), ord("9") + 1)]
+            self.add_code_points(ord("0"), ord("9"))
             return True
 
         if multi_str in "w":
-            self.match_values += [chr(x) for x in range(ord("0"), ord("9") + 1)]
-            self.match_values += [chr(x) for x in range(ord("a"), ord("z") + 1)]
-            self.match_values += [chr(x) for x in range(ord("A"), ord("Z") + 1)]
-            self.match_values.append("_")
+            self.add_code_points(ord("0"), ord("9"))
+            self.add_code_points(ord("a"), ord("z"))
+            self.add_code_points(ord("A"), ord("Z"))
+            self.add_char("_")
             return True
 
         if multi_str in "s":
-            self.match_values += [" ", "\n", "\t", "\r"]
+            for char in [" ", "\n", "\t", "\r"]:
+                self.add_char(char)
             return True
 
         return False
 
+    def contains(self, code_point):
+        """Returns True if the code point is in one of the ranges"""
+        index = bisect_right(self.range_starts, code_point) - 1
+        return index >= 0 and code_point <= self.range_ends[index]
+
     def is_matched(self, text, position):
         if position >= len(text):
             return False, 0
-        match = text[position] in self.match_values
+        code_point = ord(text[position])
+        if code_point < 128:
+            match = self.ascii_map[code_point] == 1
+        else:
+            match = self.memo.get(code_point)
+            if match is None:
+                match = self.contains(code_point) != self.is_negative
+                if len(self.memo) < MultiMatchState.memo_size:
+                    self.memo[code_point] = match
         return match, 1 if match else 0
 
 
@@ -192,9 +283,13 @@ class MultiMatchUnicodeState(State):
     *    unicode categories like L, Lo, etc
     *    unicode groups with full names, like Letters, Other_Letters, etc
     *    TODO: integrate with non-unicode multi match
+
+    The property is compiled once into a two level bitmap of the matched code points (negation included), see
+    unicode.property_bitmap, so a character is checked with two array lookups.
+    Matched code point ranges, if given, are used instead of looking the property up (see unicode.matched_ranges).
     """
 
-    def __init__(self, state_label, match_value, output_states, is_negative):
+    def __init__(self, state_label, match_value, output_states, is_negative, ranges=None):
         super().__init__("u-multi match", state_label, [], output_states)
         self.is_negative = is_negative
 
@@ -202,12 +297,12 @@ class MultiMatchUnicodeState(State):
         # * category
         # * block
         # * script
-        match_type = unicode.name_to_type[match_value]
+        match_type = unicode.get_name_to_type()[match_value]
         if match_type == "long category":
             self.match_values = unicode.category_hierarchy[unicode.long_to_short_category[match_value]]
             self.match_type = "short subcategory"
         elif match_type == "long subcategory":
-            self.match_values[0] = unicode.long_to_short_category[match_value]
+            self.match_values = [unicode.long_to_short_category[match_value]]
             self.match_type = "short subcategory"
         elif match_type == "short category":
             self.match_values = unicode.category_hierarchy[match_value]
@@ -215,51 +310,33 @@ class MultiMatchUnicodeState(State):
         else:
             self.match_values = [match_value]
             self.match_type = match_type
+        self.block_index, self.blocks = unicode.property_bitmap(self.match_type, self.match_values, is_negative,
+                                                                ranges)
+
+    def matched_ranges(self):
+        """Returns sorted list of (first, last) code points the state matches"""
+        return unicode.matched_ranges(self.match_type, self.match_values, self.is_negative)
 
     def is_matched(self, text, position):
         if position >= len(text):
             return False, 0
-        if self.match_type == "short subcategory":
-            if (not self.is_negative and unicodedata.category(text[position]) in self.match_values) or \
-                    (self.is_negative and unicodedata.category(text[position]) not in self.match_values):
-                return True, 1
-            else:
-                return False, 0
-        elif self.match_type == "block":
-            if (not self.is_negative and
-                    unicode.unicode_blocks[self.match_values[0]][0] <= ord(text[position])
-                    <= unicode.unicode_blocks[self.match_values[0]][1]) or\
-                    (self.is_negative and
-                     not (unicode.unicode_blocks[self.match_values[0]][0] <= ord(text[position])
-                          <= unicode.unicode_blocks[self.match_values[0]][1])):
-                return True, 1
-            else:
-                return False, 0
-        elif self.match_type == "script":
-            if (not self.is_negative and unicodedata2.script(text[position]) in self.match_values) or \
-                    (self.is_negative and unicodedata2.script(text[position]) not in self.match_values):
-                return True, 1
-            else:
-                return False, 0
-        else:
-            return False, 0
+        code_point = ord(text[position])
+        if self.blocks[self.block_index[code_point >> 8]][code_point & 0xFF]:
+            return True, 1
+        return False, 0
 
 
 class NegativeMultiMatchState(MultiMatchState):
-    """This state handles negative matches, that is: [^...] syntax. It's based on MultiMatchState and simply negates its
-    is_match value.
+    """This state handles negative matches, that is: [^...] syntax. It's based on MultiMatchState, its ascii_map and
+    memo hold negated decisions.
     """
 
+    is_negative = True
+
     def __init__(self, state_label, match_values, output_states):
         super().__init__(state_label, match_values, output_states)
         self.state_label = "neg multi match"
 
-    def is_matched(self, text, position):
-        if position >= len(text):
-            return False, 0
-        match = text[position] not in self.match_values
-        return match, 1 if match else 0
-
 
 class MatchAllState(State):
     def __init__(self, state_label, output_states):
@@ -284,15 +361,18 @@ class RecurringState(State):
     range (min_rep, max_rep)
     Each time interpreter goes though an edge from loop_back_output_states, it updates rep counter (+1).
     If the interpreter goes though output_states edge to the rec node, the rep counter is set to 1.
+    If the interpreter leaves the rec node (output_states and loop_back_output_states of the rec node), the rep counter
+    is set to 0, so threads differing only in counters of loops they left are equivalent.
     This way nested loops work correctly.
     If rep counter is below min_rep, the edges from output_states of rec node are not used.
     If rep counter is above max_rep, the edges from loop_output_states of rec node are not used.
     """
 
-    def __init__(self, state_label, loop_output_states, min_rep, max_rep):
+    def __init__(self, state_label, loop_output_states, min_rep, max_rep, rec_no=0):
         self.min_rep = min_rep
         self.max_rep = max_rep
         self.loop_output_states = loop_output_states
+        self.rec_no = rec_no  # index of the state in the parser's rec_list, used to address repetition counters
 
         super().__init__("repetition", state_label, None, [])
 
@@ -301,6 +381,44 @@ class RecurringState(State):
         # than the interpreter iterates over output states to check if any of them match
         return True, 0
 
+    def saturate(self, rep_counter):
+        """Returns the smallest counter value behaving the same as rep_counter. Unbounded loops (max_rep = 999999)
+        only compare the counter with min_rep, so counting beyond min_rep + 1 doesn't change anything"""
+        if self.max_rep >= 999999:
+            return min(rep_counter, self.min_rep + 1)
+        return rep_counter
+
+    def edge_set(self, rep_counter):
+        """Returns the output edges a thread with the counter follows, the rules are the same for all engines:
+        * "loop" - the min loop counter wasn't reached, only looping back for the next repetition is allowed
+        * "all" - the max loop counter wasn't reached, looping back along with going forward
+        * "output" - only going forward"""
+        if rep_counter < self.min_rep + 1:
+            return "loop"
+        if rep_counter <= self.max_rep + 1:
+            return "all"
+        return "output"
+
+    def set_counter(self, rep_counters, rep_counter):
+        """Returns copy of the counter vector with the state's counter set to rep_counter"""
+        return rep_counters[:self.rec_no] + (self.saturate(rep_counter),) + rep_counters[self.rec_no + 1:]
+
+    def enter_counters(self, rep_counters, is_loop_back):
+        """Returns the counter vector after entering the state: an output edge sets the counter to 1, a loop back
+        edge increments it. Returns None if looping back would go over max_rep"""
+        rep_counter = 1
+        if is_loop_back:
+            rep_counter = rep_counters[self.rec_no]
+            if rep_counter > self.max_rep:
+                return None
+            rep_counter += 1
+        return self.set_counter(rep_counters, rep_counter)
+
+    def exit_counters(self, rep_counters):
+        """Returns the counter vector after leaving the state through its output or loop back output edges, the
+        counter is cleared, it's only read again after entering the state"""
+        return self.set_counter(rep_counters, 0)
+
     def output_states_to_string(self):
         ret = ""
         for state in self.output_states:
@@ -1,4 +1,5 @@
-import unicodedata2
+from array import array
+import unicodedata
 
 unicode_blocks = {
     "InBasic_Latin": ( int("0000", 16), int("007F", 16) ),
@@ -158,16 +159,149 @@ category_hierarchy = {
     "Z":	["Zs", "Zl", "Zp"]
 }
 
-name_to_type = {}
-for key in unicode_blocks.keys():
-    name_to_type[key] = "block"
-for key, value in long_to_short_category.items():
-    if len(value) == 1:
-        name_to_type[value] = "short category"
-        name_to_type[key] = "long category"
-    else:
-        name_to_type[value] = "short subcategory"
-        name_to_type[key] = "long subcategory"
-for script in unicodedata2.script_data["names"]:
-    name_to_type[script] = "script"
+# unicode group name -> type of the group, built on first use of a unicode group, see get_name_to_type
+name_to_type = None
 
+
+max_code_point = 0x10FFFF
+bitmap_block_size = 256  # code points per block of a property bitmap
+
+category_ranges = None  # short subcategory -> list of (first, last) code points, built on first use
+property_bitmaps = {}  # (match type, match values, is_negative) -> (block_index, blocks), see property_bitmap
+property_code_points = {}  # (match type, match values, is_negative) -> matched ranges, see matched_ranges
+
+
+def get_name_to_type():
+    """Returns dict unicode group name -> type of the group. The script table (unicodedata2) is loaded here, so
+    patterns without unicode groups never load it"""
+    global name_to_type
+    if name_to_type is None:
+        import unicodedata2
+
+        name_to_type = {}
+        for key in unicode_blocks.keys():
+            name_to_type[key] = "block"
+        for key, value in long_to_short_category.items():
+            if len(value) == 1:
+                name_to_type[value] = "short category"
+                name_to_type[key] = "long category"
+            else:
+                name_to_type[value] = "short subcategory"
+                name_to_type[key] = "long subcategory"
+        for script in unicodedata2.script_data["names"]:
+            name_to_type[script] = "script"
+    return name_to_type
+
+
+def get_category_ranges():
+    """Returns dict short subcategory -> sorted list of (first, last) code point ranges of the subcategory.
+    Built once by a single scan of all code points"""
+    global category_ranges
+    if category_ranges is None:
+        category_ranges = {}
+        first = 0
+        category = unicodedata.category(chr(0))
+        for code_point in range(1, max_code_point + 1):
+            next_category = unicodedata.category(chr(code_point))
+            if next_category != category:
+                category_ranges.setdefault(category, []).append((first, code_point - 1))
+                first = code_point
+                category = next_category
+        category_ranges.setdefault(category, []).append((first, max_code_point))
+    return category_ranges
+
+
+def property_ranges(match_type, match_values):
+    """Returns sorted, merged list of (first, last) code point ranges matched by the unicode property"""
+    ranges = []
+    if match_type == "short subcategory":
+        for category in match_values:
+            ranges += get_category_ranges().get(category, [])
+    elif match_type == "block":
+        ranges.append(unicode_blocks[match_values[0]])
+    elif match_type == "script":
+        import unicodedata2
+
+        names = unicodedata2.script_data["names"]
+        ranges += [(first, last) for first, last, name, _ in unicodedata2.script_data["idx"]
+                   if names[name] in match_values]
+
+    merged = []
+    for first, last in sorted(ranges):
+        if len(merged) > 0 and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def negate_ranges(ranges):
+    """Returns the code point ranges not in the sorted, merged ranges"""
+    ret = []
+    first = 0
+    for range_first, range_last in ranges:
+        if range_first > first:
+            ret.append((first, range_first - 1))
+        first = range_last + 1
+    if first <= max_code_point:
+        ret.append((first, max_code_point))
+    return ret
+
+
+def matched_ranges(match_type, match_values, is_negative, ranges=None):
+    """Returns sorted list of (first, last) code point ranges matched by the unicode property, negation included.
+    Ranges are cached per property, ranges known already (e.g. loaded from a compiled NFA) can be given, then
+    the property isn't looked up"""
+    key = (match_type, tuple(match_values), is_negative)
+    if ranges is not None:
+        property_code_points[key] = ranges
+    if key not in property_code_points:
+        ranges = property_ranges(match_type, match_values)
+        property_code_points[key] = negate_ranges(ranges) if is_negative else ranges
+    return property_code_points[key]
+
+
+def property_bitmap(match_type, match_values, is_negative, ranges=None):
+    """Returns two level bitmap (block_index, blocks) of the code points matched by the unicode property.
+    Code point c is matched if blocks[block_index[c // bitmap_block_size]][c % bitmap_block_size] is 1.
+    Blocks are shared, all empty or full blocks are the same bytes object. Bitmaps are cached per property.
+    The matched ranges can be given, see matched_ranges"""
+    key = (match_type, tuple(match_values), is_negative)
+    bitmap = property_bitmaps.get(key)
+    if bitmap is not None:
+        return bitmap
+
+    ranges = matched_ranges(match_type, match_values, is_negative, ranges)
+    block_count = max_code_point // bitmap_block_size + 1
+    block_bits = [None] * block_count  # bytearray of a block with some code points matched
+    full_blocks = bytearray(block_count)
+    for first, last in ranges:
+        while first <= last:
+            block = first // bitmap_block_size
+            block_last = min(last, (block + 1) * bitmap_block_size - 1)
+            if first % bitmap_block_size == 0 and block_last % bitmap_block_size == bitmap_block_size - 1:
+                full_blocks[block] = 1
+            else:
+                if block_bits[block] is None:
+                    block_bits[block] = bytearray(bitmap_block_size)
+                offset = block * bitmap_block_size
+                block_bits[block][first - offset:block_last - offset + 1] = \
+                    bytes([1]) * (block_last - first + 1)
+            first = block_last + 1
+
+    blocks = [bytes(bitmap_block_size), bytes([1]) * bitmap_block_size]
+    block_numbers = {blocks[0]: 0, blocks[1]: 1}
+    block_index = array("H", bytes(2 * block_count))
+    for block in range(block_count):
+        if full_blocks[block]:
+            block_index[block] = 1
+        elif block_bits[block] is not None:
+            bits = bytes(block_bits[block])
+            if bits not in block_numbers:
+                block_numbers[bits] = len(blocks)
+                blocks.append(bits)
+            block_index[block] = block_numbers[bits]
+
+    bitmap = (block_index, blocks)
+    property_bitmaps[key] = bitmap
+    return bitmap